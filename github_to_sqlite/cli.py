@@ -4,16 +4,66 @@ import itertools
 import pathlib
 import textwrap
 import os
+import requests
 import sqlite_utils
-import time
 import json
 from github_to_sqlite import utils
 
+# Page cache and memory-mapped I/O sizes for the connections we write with
+CACHE_SIZE_KB = 64 * 1024
+MMAP_SIZE = 256 * 1024 * 1024
+# Commands that need a repository's id reuse its details for this long
+REPO_MAX_AGE = 60 * 60
+
 
 @click.group()
 @click.version_option()
-def cli():
+@click.option(
+    "--wal",
+    is_flag=True,
+    help="Use WAL mode, so the database can be read while it is being written",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=utils.BATCH_SIZE,
+    show_default=True,
+    help="Number of records to write in each transaction",
+)
+@click.option(
+    "--synchronous",
+    type=click.Choice(["OFF", "NORMAL", "FULL", "EXTRA"], case_sensitive=False),
+    help="SQLite synchronous setting, defaults to NORMAL with --wal",
+)
+@click.option(
+    "--http-cache/--no-http-cache",
+    default=True,
+    help="Skip API responses that are unchanged since they were last saved",
+)
+@click.option(
+    "--repo-max-age",
+    type=click.IntRange(min=0),
+    default=REPO_MAX_AGE,
+    show_default=True,
+    help="Seconds to reuse repository details fetched by an earlier run",
+)
+@click.option(
+    "--defer-fts",
+    is_flag=True,
+    help="Rebuild full-text search indexes at the end instead of row by row",
+)
+@click.pass_context
+def cli(ctx, wal, batch_size, synchronous, http_cache, repo_max_age, defer_fts):
     "Save data from GitHub to a SQLite database"
+    ctx.obj = {
+        "wal": wal,
+        "batch_size": batch_size,
+        "synchronous": synchronous,
+        "http_cache": http_cache,
+        "repo_max_age": repo_max_age,
+        "defer_fts": defer_fts,
+    }
+    utils.disable_http_cache()
 
 
 @cli.command()
@@ -63,19 +113,56 @@ def auth(auth):
     type=click.Path(file_okay=True, dir_okay=False, allow_dash=True, exists=True),
     help="Load issues JSON from this file instead of the API",
 )
-def issues(db_path, repo, issue_ids, auth, load):
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="Only fetch issues updated since the last --incremental run",
+)
+@click.option(
+    "--graphql",
+    is_flag=True,
+    help="Use the GraphQL API to fetch issues together with their comments",
+)
+def issues(db_path, repo, issue_ids, auth, load, incremental, graphql):
     "Save issues for a specified repository, e.g. simonw/datasette"
-    db = sqlite_utils.Database(db_path)
+    db = open_db(db_path)
     token = load_token(auth)
     repo_full = utils.fetch_repo(repo, token)
     utils.save_repo(db, repo_full)
+    incremental = incremental and not (load or issue_ids)
+    graphql = graphql and not (load or issue_ids)
+    if graphql and not token:
+        raise click.ClickException("--graphql requires a GitHub token")
+    newest = {}
+    since = None
+    if incremental:
+        since = utils.get_sync_state(db, repo_full["full_name"], "issues")
     if load:
-        issues = json.load(open(load))
+        issues = utils.iter_json_items(click.open_file(load))
+        utils.save_issues(db, issues, repo_full)
+    elif graphql:
+        fetched = utils.fetch_issues_graphql(repo_full["full_name"], token, since)
+        for batch in utils.batches(fetched, utils.get_batch_size(db)):
+            issues = list(utils.track_newest((issue for issue, _ in batch), newest))
+            utils.save_issues(db, issues, repo_full)
+            utils.save_issue_comments(
+                db,
+                (comment for _, comments in batch for comment in comments),
+                issue_ids={
+                    (repo_full["full_name"], issue["number"]): issue["id"]
+                    for issue in issues
+                },
+            )
     else:
-        issues = utils.fetch_issues(repo, token, issue_ids)
+        issues = utils.fetch_issues(repo, token, issue_ids, since=since)
+        issues = utils.track_newest(issues, newest)
+        utils.save_issues(db, issues, repo_full)
 
-    issues = list(issues)
-    utils.save_issues(db, issues, repo_full)
+    if incremental:
+        utils.save_sync_state(
+            db, repo_full["full_name"], "issues", newest.get("updated_at")
+        )
+    utils.save_http_cache(db)
     utils.ensure_db_shape(db)
 
 
@@ -119,14 +206,21 @@ def issues(db_path, repo, issue_ids, auth, load):
     "--search",
     help="Find pull requests with a search query",
 )
-def pull_requests(db_path, repo, pull_request_ids, auth, load, orgs, state, search):
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="Only fetch pull requests updated since the last --incremental run",
+)
+def pull_requests(
+    db_path, repo, pull_request_ids, auth, load, orgs, state, search, incremental
+):
     "Save pull_requests for a specified repository, e.g. simonw/datasette"
-    db = sqlite_utils.Database(db_path)
+    db = open_db(db_path)
     token = load_token(auth)
     if load:
         repo_full = utils.fetch_repo(repo, token)
         utils.save_repo(db, repo_full)
-        pull_requests = json.load(open(load))
+        pull_requests = utils.iter_json_items(click.open_file(load))
         utils.save_pull_requests(db, pull_requests, repo_full)
     elif search:
         repos_seen = set()
@@ -147,11 +241,26 @@ def pull_requests(db_path, repo, pull_request_ids, auth, load, orgs, state, sear
             )
         else:
             repos = [utils.fetch_repo(repo, token)]
+        incremental = incremental and not pull_request_ids
+        # Each --state needs its own record of how far we have got
+        resource = "pull_requests" if state in (None, "all") else f"pulls:{state}"
         for repo_full in repos:
             utils.save_repo(db, repo_full)
             repo = repo_full["full_name"]
-            pull_requests = utils.fetch_pull_requests(repo, state, token, pull_request_ids)
+            since = None
+            if incremental:
+                since = utils.get_sync_state(db, repo, resource)
+            newest = {}
+            pull_requests = utils.track_newest(
+                utils.fetch_pull_requests(
+                    repo, state, token, pull_request_ids, since=since
+                ),
+                newest,
+            )
             utils.save_pull_requests(db, pull_requests, repo_full)
+            if incremental:
+                utils.save_sync_state(db, repo, resource, newest.get("updated_at"))
+    utils.save_http_cache(db)
     utils.ensure_db_shape(db)
 
 
@@ -170,12 +279,27 @@ def pull_requests(db_path, repo, pull_request_ids, auth, load, orgs, state, sear
     default="auth.json",
     help="Path to auth.json token file",
 )
-def issue_comments(db_path, repo, issue, auth):
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="Only fetch comments updated since the last --incremental run",
+)
+def issue_comments(db_path, repo, issue, auth, incremental):
     "Retrieve issue comments for a specific repository"
-    db = sqlite_utils.Database(db_path)
+    db = open_db(db_path)
     token = load_token(auth)
-    for comment in utils.fetch_issue_comments(repo, token, issue):
-        utils.save_issue_comment(db, comment)
+    incremental = incremental and issue is None
+    since = None
+    if incremental:
+        since = utils.get_sync_state(db, repo, "issue_comments")
+    newest = {}
+    comments = utils.track_newest(
+        utils.fetch_issue_comments(repo, token, issue, since=since), newest
+    )
+    utils.save_issue_comments(db, comments, utils.load_issue_ids(db, repo))
+    if incremental:
+        utils.save_sync_state(db, repo, "issue_comments", newest.get("updated_at"))
+    utils.save_http_cache(db)
     utils.ensure_db_shape(db)
 
 
@@ -200,10 +324,10 @@ def issue_comments(db_path, repo, issue, auth):
 )
 def starred(db_path, username, auth, load):
     "Save repos starred by the specified (or authenticated) username"
-    db = sqlite_utils.Database(db_path)
+    db = open_db(db_path)
     token = load_token(auth)
     if load:
-        stars = json.load(open(load))
+        stars = utils.iter_json_items(click.open_file(load))
     else:
         stars = utils.fetch_all_starred(username, token)
 
@@ -214,6 +338,7 @@ def starred(db_path, username, auth, load):
         user = utils.fetch_user(token=token)
 
     utils.save_stars(db, user, stars)
+    utils.save_http_cache(db)
     utils.ensure_db_shape(db)
 
 
@@ -231,15 +356,23 @@ def starred(db_path, username, auth, load):
     default="auth.json",
     help="Path to auth.json token file",
 )
-def stargazers(db_path, repos, auth):
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of repositories to fetch at once",
+)
+def stargazers(db_path, repos, auth, concurrency):
     "Fetch the users that have starred the specified repositories"
-    db = sqlite_utils.Database(db_path)
+    db = open_db(db_path)
     token = load_token(auth)
-    for repo in repos:
-        full_repo = utils.fetch_repo(repo, token=token)
+    for full_repo, stargazers in utils.fetch_for_repos(
+        repos, token, lambda repo: utils.fetch_stargazers(repo, token), concurrency
+    ):
         repo_id = utils.save_repo(db, full_repo)
-        stargazers = utils.fetch_stargazers(repo, token)
         utils.save_stargazers(db, repo_id, stargazers)
+    utils.save_http_cache(db)
     utils.ensure_db_shape(db)
 
 
@@ -278,38 +411,67 @@ def stargazers(db_path, repos, auth):
     is_flag=True,
     help="Fetch HTML rendered README into 'readme_html' column",
 )
-def repos(db_path, usernames, auth, repo, load, readme, readme_html):
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of READMEs to fetch at once",
+)
+def repos(db_path, usernames, auth, repo, load, readme, readme_html, concurrency):
     "Save repos owned by the specified (or authenticated) username or organization"
-    db = sqlite_utils.Database(db_path)
+    db = open_db(db_path)
     token = load_token(auth)
     if load:
-        for loaded_repo in json.load(open(load)):
-            utils.save_repo(db, loaded_repo)
+        all_repos = utils.iter_json_items(click.open_file(load))
+    elif repo:
+        # Just these repos
+        all_repos = (
+            utils.fetch_repo(full_name, token, max_age=0) for full_name in repo
+        )
     else:
-        if repo:
-            # Just these repos
-            for full_name in repo:
-                repo_id = utils.save_repo(db, utils.fetch_repo(full_name, token))
-                _repo_readme(db, token, repo_id, full_name, readme, readme_html)
-        else:
-            if not usernames:
-                usernames = [None]
-            for username in usernames:
-                for repo in utils.fetch_all_repos(username, token):
-                    repo_id = utils.save_repo(db, repo)
-                    _repo_readme(
-                        db, token, repo_id, repo["full_name"], readme, readme_html
-                    )
+        all_repos = itertools.chain.from_iterable(
+            utils.fetch_all_repos(
+                username, token, conditional=not (readme or readme_html)
+            )
+            for username in (usernames or [None])
+        )
+    columns = [
+        column
+        for column, wanted in (("readme", readme), ("readme_html", readme_html))
+        if wanted and not load
+    ]
+    if columns:
+        previous = utils.load_repo_readmes(db, columns)
+        all_repos = utils.map_concurrently(
+            lambda repo: _with_readmes(token, repo, columns, previous.get(repo["id"])),
+            all_repos,
+            concurrency,
+        )
+    for batch in utils.batches(all_repos, utils.get_batch_size(db)):
+        with utils.transaction(db):
+            for repo_to_save in batch:
+                utils.save_repo(db, repo_to_save)
+    utils.save_http_cache(db)
     utils.ensure_db_shape(db)
 
 
-def _repo_readme(db, token, repo_id, full_name, readme, readme_html):
-    if readme:
-        readme = utils.fetch_readme(token, full_name)
-        db["repos"].update(repo_id, {"readme": readme}, alter=True)
-    if readme_html:
-        readme_html = utils.fetch_readme(token, full_name, html=True)
-        db["repos"].update(repo_id, {"readme_html": readme_html}, alter=True)
+def _with_readmes(token, repo, columns, previous):
+    "Add README columns to repo - runs in a worker thread"
+    repo = dict(repo)
+    for column in columns:
+        # Nothing has been pushed since we last fetched this README
+        if (
+            previous
+            and previous["pushed_at"] == repo.get("pushed_at")
+            and previous[column] is not None
+        ):
+            repo[column] = previous[column]
+        else:
+            repo[column] = utils.fetch_readme(
+                token, repo["full_name"], html=column == "readme_html"
+            )
+    return repo
 
 
 @cli.command()
@@ -326,19 +488,32 @@ def _repo_readme(db, token, repo_id, full_name, readme, readme_html):
     default="auth.json",
     help="Path to auth.json token file",
 )
-def releases(db_path, repos, auth):
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of repositories to fetch at once",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="Stop at the first release that is already saved and unchanged",
+)
+def releases(db_path, repos, auth, concurrency, incremental):
     "Save releases for the specified repos"
-    db = sqlite_utils.Database(db_path)
+    db = open_db(db_path)
     token = load_token(auth)
-    first = True
-    for repo in repos:
-        if not first:
-            time.sleep(1)
-        first = False
-        repo_full = utils.fetch_repo(repo, token)
+    stop_when = utils.stop_at_known_releases(db, repos) if incremental else None
+    for repo_full, releases in utils.fetch_for_repos(
+        repos,
+        token,
+        lambda repo: utils.fetch_releases(repo, token, stop_when),
+        concurrency,
+    ):
         utils.save_repo(db, repo_full)
-        releases = utils.fetch_releases(repo, token)
         utils.save_releases(db, releases, repo_full["id"])
+    utils.save_http_cache(db)
     utils.ensure_db_shape(db)
 
 
@@ -356,19 +531,23 @@ def releases(db_path, repos, auth):
     default="auth.json",
     help="Path to auth.json token file",
 )
-def tags(db_path, repos, auth):
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of repositories to fetch at once",
+)
+def tags(db_path, repos, auth, concurrency):
     "Save tags for the specified repos"
-    db = sqlite_utils.Database(db_path)
+    db = open_db(db_path)
     token = load_token(auth)
-    first = True
-    for repo in repos:
-        if not first:
-            time.sleep(1)
-        first = False
-        repo_full = utils.fetch_repo(repo, token)
+    for repo_full, tags in utils.fetch_for_repos(
+        repos, token, lambda repo: utils.fetch_tags(repo, token), concurrency
+    ):
         utils.save_repo(db, repo_full)
-        tags = utils.fetch_tags(repo, token)
         utils.save_tags(db, tags, repo_full["id"])
+    utils.save_http_cache(db)
     utils.ensure_db_shape(db)
 
 
@@ -386,16 +565,23 @@ def tags(db_path, repos, auth):
     default="auth.json",
     help="Path to auth.json token file",
 )
-def contributors(db_path, repos, auth):
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of repositories to fetch at once",
+)
+def contributors(db_path, repos, auth, concurrency):
     "Save contributors for the specified repos"
-    db = sqlite_utils.Database(db_path)
+    db = open_db(db_path)
     token = load_token(auth)
-    for repo in repos:
-        repo_full = utils.fetch_repo(repo, token)
+    for repo_full, contributors in utils.fetch_for_repos(
+        repos, token, lambda repo: utils.fetch_contributors(repo, token), concurrency
+    ):
         utils.save_repo(db, repo_full)
-        contributors = utils.fetch_contributors(repo, token)
         utils.save_contributors(db, contributors, repo_full["id"])
-        time.sleep(1)
+    utils.save_http_cache(db)
     utils.ensure_db_shape(db)
 
 
@@ -412,6 +598,14 @@ def contributors(db_path, repos, auth):
     default=False,
     help="Load all commits (not just those that have not yet been saved)",
 )
+@click.option(
+    "--since",
+    help="Only fetch commits made after this ISO 8601 date or timestamp",
+)
+@click.option(
+    "--sha",
+    help="Fetch commits starting from this branch name or commit SHA",
+)
 @click.option(
     "-a",
     "--auth",
@@ -419,29 +613,40 @@ def contributors(db_path, repos, auth):
     default="auth.json",
     help="Path to auth.json token file",
 )
-def commits(db_path, repos, all, auth):
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of repositories to fetch at once",
+)
+def commits(db_path, repos, all, since, sha, auth, concurrency):
     "Save commits for the specified repos"
-    db = sqlite_utils.Database(db_path)
+    db = open_db(db_path)
     token = load_token(auth)
 
-    def stop_when(commit):
-        try:
-            db["commits"].get(commit["sha"])
-            return True
-        except sqlite_utils.db.NotFoundError:
-            return False
+    stop_when = None
+    known_shas = set()
+    if not all:
+        # Loaded once, up front, so stop_when can run in the fetching threads
+        # without a query per commit. Like the old primary key lookup this
+        # spans every repo, and SHAs saved by this run are added as each repo
+        # is saved so a fork stops at history shared with an earlier repo
+        known_shas = utils.load_commit_shas(db)
 
-    if all:
-        stop_when = None
+        def stop_when(commit):
+            return commit["sha"] in known_shas
 
-    for repo in repos:
-        repo_full = utils.fetch_repo(repo, token)
+    for repo_full, commits in utils.fetch_for_repos(
+        repos,
+        token,
+        lambda repo: utils.fetch_commits(repo, token, stop_when, since=since, sha=sha),
+        concurrency,
+    ):
         utils.save_repo(db, repo_full)
+        known_shas.update(utils.save_commits(db, commits, repo_full["id"]))
 
-        commits = utils.fetch_commits(repo, token, stop_when)
-        utils.save_commits(db, commits, repo_full["id"])
-        time.sleep(1)
-
+    utils.save_http_cache(db)
     utils.ensure_db_shape(db)
 
 
@@ -465,49 +670,86 @@ def commits(db_path, repos, all, auth):
     is_flag=True,
     help="Verbose output",
 )
-def scrape_dependents(db_path, repos, auth, verbose):
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of dependent repositories to fetch at once",
+)
+def scrape_dependents(db_path, repos, auth, verbose, concurrency):
     "Scrape dependents for specified repos"
     try:
         import bs4
     except ImportError:
         raise click.ClickException("Optional dependency bs4 is needed for this command")
-    db = sqlite_utils.Database(db_path)
+    db = open_db(db_path)
     token = load_token(auth)
 
+    # Loaded once, up front, instead of two queries per scraped dependent
+    known_ids = {}
+    if db["repos"].exists():
+        known_ids = dict(db.execute("select full_name, id from repos").fetchall())
+
+    def fetch_dependent(full_name):
+        # Runs in a worker thread - only repos we have never seen are fetched
+        if full_name in known_ids:
+            return full_name, None
+        return full_name, utils.fetch_repo(full_name, token)
+
     for repo in repos:
         repo_full = utils.fetch_repo(repo, token)
         utils.save_repo(db, repo_full)
-
-        for dependent_repo in utils.scrape_dependents(repo, verbose):
-            # Don't fetch repo details if it's already in our DB
-            existing = list(db["repos"].rows_where("full_name = ?", [dependent_repo]))
-            dependent_id = None
-            if not existing:
-                dependent_full = utils.fetch_repo(dependent_repo, token)
-                time.sleep(1)
-                utils.save_repo(db, dependent_full)
-                dependent_id = dependent_full["id"]
-            else:
-                dependent_id = existing[0]["id"]
-            # Only insert if it isn't already there:
-            if not db["dependents"].exists() or not list(
-                db["dependents"].rows_where(
-                    "repo = ? and dependent = ?", [repo_full["id"], dependent_id]
-                )
-            ):
-                db["dependents"].insert(
-                    {
-                        "repo": repo_full["id"],
-                        "dependent": dependent_id,
-                        "first_seen_utc": datetime.datetime.utcnow().isoformat(),
-                    },
-                    pk=("repo", "dependent"),
-                    foreign_keys=(
-                        ("repo", "repos", "id"),
-                        ("dependent", "repos", "id"),
-                    ),
+        known_ids[repo_full["full_name"]] = repo_full["id"]
+        existing = set()
+        if db["dependents"].exists():
+            existing = {
+                row[0]
+                for row in db.execute(
+                    "select dependent from dependents where repo = ?", [repo_full["id"]]
                 )
+            }
+
+        def unique_dependents():
+            seen = set()
+            for dependent_repo in utils.scrape_dependents(repo, verbose):
+                if dependent_repo not in seen:
+                    seen.add(dependent_repo)
+                    yield dependent_repo
+
+        fetched = utils.map_concurrently(
+            fetch_dependent, unique_dependents(), concurrency
+        )
+        for batch in utils.batches(fetched, utils.get_batch_size(db)):
+            with utils.transaction(db):
+                rows = []
+                for dependent_repo, dependent_full in batch:
+                    if dependent_full is not None:
+                        utils.save_repo(db, dependent_full)
+                        known_ids[dependent_repo] = dependent_full["id"]
+                    dependent_id = known_ids[dependent_repo]
+                    # Only insert if it isn't already there:
+                    if dependent_id in existing:
+                        continue
+                    existing.add(dependent_id)
+                    rows.append(
+                        {
+                            "repo": repo_full["id"],
+                            "dependent": dependent_id,
+                            "first_seen_utc": datetime.datetime.utcnow().isoformat(),
+                        }
+                    )
+                if rows:
+                    db["dependents"].insert_all(
+                        rows,
+                        pk=("repo", "dependent"),
+                        foreign_keys=(
+                            ("repo", "repos", "id"),
+                            ("dependent", "repos", "id"),
+                        ),
+                    )
 
+    utils.save_http_cache(db)
     utils.ensure_db_shape(db)
 
 
@@ -530,24 +772,51 @@ def scrape_dependents(db_path, repos, auth, verbose):
     is_flag=True,
     help="Fetch the image data into a BLOB column",
 )
-def emojis(db_path, auth, fetch):
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=8,
+    show_default=True,
+    help="Number of images to download at once",
+)
+def emojis(db_path, auth, fetch, concurrency):
     "Fetch GitHub supported emojis"
-    db = sqlite_utils.Database(db_path)
+    db = open_db(db_path)
     token = load_token(auth)
     table = db.table("emojis", pk="name")
     table.upsert_all(utils.fetch_emojis(token))
     if fetch:
-        # Ensure table has 'image' column
+        # Ensure table has 'image' and 'image_url' columns
         if "image" not in table.columns_dict:
             table.add_column("image", bytes)
+        if "image_url" not in table.columns_dict:
+            table.add_column("image_url", str)
+        # Many emojis are aliases sharing one image. Download each image once,
+        # and again only if its URL (which includes a version) changes. Images
+        # saved before image_url was recorded have it null, so are downloaded
+        # again once
+        urls = [
+            row[0]
+            for row in db.execute(
+                "select distinct url from emojis "
+                "where image is null or image_url is not url order by url"
+            )
+        ]
+        images = utils.map_concurrently(utils.fetch_image, urls, concurrency)
         with click.progressbar(
-            list(table.rows_where("image is null")),
+            zip(urls, images),
+            length=len(urls),
             show_pos=True,
             show_eta=True,
             show_percent=True,
         ) as bar:
-            for emoji in bar:
-                table.update(emoji["name"], {"image": utils.fetch_image(emoji["url"])})
+            for batch in utils.batches(bar, utils.get_batch_size(db)):
+                with utils.transaction(db):
+                    for url, image in batch:
+                        db.execute(
+                            "update emojis set image = ?, image_url = ? where url = ?",
+                            [image, url, url],
+                        )
 
 
 @cli.command()
@@ -624,17 +893,280 @@ def get(url, auth, paginate, nl, accept):
     default="auth.json",
     help="Path to auth.json token file",
 )
-def workflows(db_path, repos, auth):
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of repositories to fetch at once",
+)
+def workflows(db_path, repos, auth, concurrency):
     "Fetch details of GitHub Actions workflows for the specified repositories"
-    db = sqlite_utils.Database(db_path)
+    db = open_db(db_path)
     token = load_token(auth)
-    for repo in repos:
-        full_repo = utils.fetch_repo(repo, token=token)
+    for full_repo, workflows in utils.fetch_for_repos(
+        repos,
+        token,
+        lambda repo: utils.fetch_workflows(token, repo).items(),
+        concurrency,
+    ):
         repo_id = utils.save_repo(db, full_repo)
-        workflows = utils.fetch_workflows(token, full_repo["full_name"])
-        for filename, content in workflows.items():
+        for filename, content in workflows:
             utils.save_workflow(db, repo_id, filename, content)
+    utils.save_http_cache(db)
+    utils.ensure_db_shape(db)
+
+
+SYNC_RESOURCES = (
+    "issues",
+    "pull-requests",
+    "issue-comments",
+    "commits",
+    "releases",
+    "tags",
+    "contributors",
+    "stargazers",
+    "workflows",
+)
+# Failures that only stop one resource of one repo from syncing
+SYNC_ERRORS = (utils.GitHubError, requests.RequestException)
+# The name each resource's --incremental progress is recorded under
+SYNC_STATE_RESOURCES = {
+    "issues": "issues",
+    "pull-requests": "pull_requests",
+    "issue-comments": "issue_comments",
+}
+
+
+@cli.command()
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+@click.argument("repos", type=str, nargs=-1)
+@click.option(
+    "--org",
+    "orgs",
+    help="Sync every repository belonging to this GitHub organization",
+    multiple=True,
+)
+@click.option(
+    "-r",
+    "--resource",
+    "resources",
+    type=click.Choice(SYNC_RESOURCES),
+    multiple=True,
+    help="Resources to sync, defaults to all of them",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="Only fetch new or updated issues, pull requests, comments and releases",
+)
+@click.option(
+    "-a",
+    "--auth",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=True),
+    default="auth.json",
+    help="Path to auth.json token file",
+)
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of fetches to run at once",
+)
+def sync(db_path, repos, orgs, resources, incremental, auth, concurrency):
+    "Sync several kinds of data for many repositories in a single run"
+    if not (repos or orgs):
+        raise click.UsageError("Provide one or more repositories or --org")
+    db = open_db(db_path)
+    token = load_token(auth)
+    # Keep SYNC_RESOURCES order, so issues are saved before their comments
+    resources = [r for r in SYNC_RESOURCES if r in resources] or SYNC_RESOURCES
+
+    # As in the commits command, SHAs saved by this run are added to this
+    known_shas = utils.load_commit_shas(db) if "commits" in resources else set()
+
+    def stop_at_known_commit(commit):
+        return commit["sha"] in known_shas
+
+    all_repos = itertools.chain(
+        utils.map_concurrently(
+            lambda full_name: utils.fetch_repo(full_name, token), repos, concurrency
+        ),
+        itertools.chain.from_iterable(
+            utils.fetch_all_repos(token=token, org=org) for org in orgs
+        ),
+    )
+
+    def jobs():
+        # Runs on the main thread, as map_concurrently() consumes it
+        for repo_full in all_repos:
+            utils.save_repo(db, repo_full)
+            for resource in resources:
+                # The issues endpoint returns a 410 for these
+                if resource == "issues" and not repo_full.get("has_issues", True):
+                    continue
+                since = None
+                if incremental and resource in SYNC_STATE_RESOURCES:
+                    since = utils.get_sync_state(
+                        db, repo_full["full_name"], SYNC_STATE_RESOURCES[resource]
+                    )
+                stop_when = None
+                if resource == "commits":
+                    stop_when = stop_at_known_commit
+                elif incremental and resource == "releases":
+                    stop_when = utils.stop_at_known_releases(
+                        db, [repo_full["full_name"]]
+                    )
+                yield repo_full, resource, since, stop_when
+
+    def fetch(job):
+        repo_full, resource, since, stop_when = job
+        try:
+            items = _sync_fetch(
+                resource,
+                repo_full["full_name"],
+                token,
+                since,
+                stop_when,
+                # Without worker threads items can be streamed straight into
+                # the database instead of being held in memory first
+                stream=concurrency == 1,
+            )
+        except SYNC_ERRORS as e:
+            return repo_full, resource, None, e
+        return repo_full, resource, items, None
+
+    failed = 0
+    for repo_full, resource, items, error in utils.map_concurrently(
+        fetch, jobs(), concurrency
+    ):
+        full_name = repo_full["full_name"]
+        newest = {}
+        if error is None:
+            if incremental and resource in SYNC_STATE_RESOURCES:
+                items = utils.track_newest(items, newest)
+            try:
+                saved_shas = _sync_save(db, resource, items, repo_full)
+            except SYNC_ERRORS as e:
+                error = e
+        if error is not None:
+            # Report it and carry on with everything else
+            failed += 1
+            message = getattr(error, "message", error)
+            click.echo(
+                "Error syncing {} for {}: {}".format(resource, full_name, message),
+                err=True,
+            )
+            # Anything that was fetched may not have been saved
+            utils.discard_http_cache(
+                "https://api.github.com/repos/{}/".format(full_name)
+            )
+            continue
+        if resource == "commits":
+            known_shas.update(saved_shas)
+        if incremental and resource in SYNC_STATE_RESOURCES:
+            utils.save_sync_state(
+                db,
+                full_name,
+                SYNC_STATE_RESOURCES[resource],
+                newest.get("updated_at"),
+            )
+    utils.save_http_cache(db)
     utils.ensure_db_shape(db)
+    if failed:
+        raise click.ClickException(
+            "{} of the sync jobs failed, see the errors above".format(failed)
+        )
+
+
+def _sync_fetch(resource, full_name, token, since, stop_when, stream=False):
+    "Fetch everything for one resource of one repo, in a worker unless stream"
+    if resource == "issues":
+        items = utils.fetch_issues(full_name, token, since=since)
+    elif resource == "pull-requests":
+        items = utils.fetch_pull_requests(full_name, token=token, since=since)
+    elif resource == "issue-comments":
+        items = utils.fetch_issue_comments(full_name, token, since=since)
+    elif resource == "commits":
+        items = utils.fetch_commits(full_name, token, stop_when)
+    elif resource == "releases":
+        items = utils.fetch_releases(full_name, token, stop_when)
+    elif resource == "workflows":
+        items = utils.fetch_workflows(token, full_name).items()
+    else:
+        fetch = {
+            "tags": utils.fetch_tags,
+            "contributors": utils.fetch_contributors,
+            "stargazers": utils.fetch_stargazers,
+        }[resource]
+        items = fetch(full_name, token)
+    return items if stream else list(items)
+
+
+def _sync_save(db, resource, items, repo_full):
+    "Save one resource of one repo, returning the saved SHAs for commits"
+    repo_id = repo_full["id"]
+    if resource == "issues":
+        utils.save_issues(db, items, repo_full)
+    elif resource == "pull-requests":
+        utils.save_pull_requests(db, items, repo_full)
+    elif resource == "issue-comments":
+        issue_ids = utils.load_issue_ids(db, repo_full["full_name"])
+        utils.save_issue_comments(db, items, issue_ids=issue_ids)
+    elif resource == "commits":
+        return utils.save_commits(db, items, repo_id)
+    elif resource == "releases":
+        utils.save_releases(db, items, repo_id)
+    elif resource == "tags":
+        utils.save_tags(db, items, repo_id)
+    elif resource == "contributors":
+        utils.save_contributors(db, items, repo_id)
+    elif resource == "stargazers":
+        utils.save_stargazers(db, repo_id, items)
+    elif resource == "workflows":
+        for filename, content in items:
+            utils.save_workflow(db, repo_id, filename, content)
+
+
+@cli.command()
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False, exists=True),
+    required=True,
+)
+@click.option(
+    "--vacuum",
+    is_flag=True,
+    help="Also VACUUM the database to reclaim space - this can be slow",
+)
+def optimize(db_path, vacuum):
+    "Check FTS, foreign keys and views, then optimize FTS indexes and run ANALYZE"
+    db = open_db(db_path)
+    utils.optimize(db, vacuum=vacuum)
+
+
+def open_db(db_path):
+    "Open the database using the options passed to the top-level command"
+    options = click.get_current_context().find_object(dict) or {}
+    db = sqlite_utils.Database(db_path)
+    utils.configure_db(
+        db,
+        wal=options.get("wal"),
+        synchronous=options.get("synchronous"),
+        batch_size=options.get("batch_size"),
+        cache_size=CACHE_SIZE_KB,
+        mmap_size=MMAP_SIZE,
+    )
+    if options.get("http_cache"):
+        utils.enable_http_cache(db, repo_max_age=options.get("repo_max_age"))
+    if options.get("defer_fts"):
+        utils.defer_fts(db)
+    return db
 
 
 def load_token(auth):
@@ -645,4 +1177,10 @@ def load_token(auth):
     if token is None:
         # Fallback to GITHUB_TOKEN environment variable
         token = os.environ.get("GITHUB_TOKEN") or None
-    return token
+        if token and "," in token:
+            token = token.split(",")
+    # A list of tokens is used as a pool - requests made with the first are
+    # spread across all of them
+    tokens = token if isinstance(token, list) else []
+    utils.use_tokens(tokens)
+    return tokens[0] if tokens else token
@@ -1,8 +1,22 @@
 import base64
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import functools
+import hashlib
+import itertools
+import json
+import queue
 import requests
+from requests.adapters import HTTPAdapter
+from sqlite_utils.utils import hash_record
 import re
+import sqlite3
+import threading
 import time
 import urllib.parse
+from urllib3.util.retry import Retry
+import weakref
 import yaml
 
 FTS_CONFIG = {
@@ -69,10 +83,416 @@ order by
     ),
 }
 
+GRAPHQL_ACTOR = """
+login
+url
+avatarUrl
+__typename
+... on User { id databaseId }
+... on Bot { id databaseId }
+... on Mannequin { id databaseId }
+... on Organization { id databaseId }
+"""
+
+# Assignees are a UserConnection, so the Actor fragments above do not apply
+GRAPHQL_USER = """
+login
+url
+avatarUrl
+__typename
+id
+databaseId
+"""
+
+GRAPHQL_COMMENT = """
+id
+databaseId
+url
+body
+createdAt
+updatedAt
+authorAssociation
+author { %s }
+reactionGroups { content reactors { totalCount } }
+""" % GRAPHQL_ACTOR
+
+GRAPHQL_ISSUES_QUERY = """
+query($owner: String!, $name: String!, $first: Int!, $after: String,
+      $comments: Int!, $since: DateTime) {
+  repository(owner: $owner, name: $name) {
+    issues(first: $first, after: $after, filterBy: {since: $since},
+           orderBy: {field: CREATED_AT, direction: ASC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        id
+        databaseId
+        number
+        title
+        body
+        state
+        locked
+        url
+        createdAt
+        updatedAt
+        closedAt
+        authorAssociation
+        author { %s }
+        assignees(first: 10) { nodes { %s } }
+        labels(first: 100) { nodes { name } }
+        milestone { number }
+        comments(first: $comments) {
+          totalCount
+          pageInfo { hasNextPage endCursor }
+          nodes { %s }
+        }
+      }
+    }
+  }
+}
+""" % (
+    GRAPHQL_ACTOR,
+    GRAPHQL_USER,
+    GRAPHQL_COMMENT,
+)
+
+GRAPHQL_COMMENTS_QUERY = """
+query($id: ID!, $after: String) {
+  node(id: $id) {
+    ... on Issue {
+      comments(first: 100, after: $after) {
+        pageInfo { hasNextPage endCursor }
+        nodes { %s }
+      }
+    }
+  }
+}
+""" % GRAPHQL_COMMENT
+
+# GraphQL reaction content to the keys of the REST reactions object
+GRAPHQL_REACTIONS = {
+    "THUMBS_UP": "+1",
+    "THUMBS_DOWN": "-1",
+    "LAUGH": "laugh",
+    "HOORAY": "hooray",
+    "CONFUSED": "confused",
+    "HEART": "heart",
+    "ROCKET": "rocket",
+    "EYES": "eyes",
+}
+
 FOREIGN_KEYS = [
     ("repos", "license", "licenses", "key"),
 ]
 
+INDEXES = [
+    # table, columns
+    ("repos", ["full_name"]),
+]
+
+# Triggers created by enable_fts(create_triggers=True) for each table
+FTS_TRIGGER_SUFFIXES = ("_ai", "_ad", "_au")
+
+# Comments fetched with each issue by the GraphQL backend - any more are
+# fetched 100 at a time with a follow-up query
+GRAPHQL_COMMENTS_PER_ISSUE = 50
+# Rough cap on the nodes one GraphQL query asks for. Bigger queries are
+# slower to run and more likely to time out on GitHub's side
+GRAPHQL_NODE_BUDGET = 10000
+# Release fields compared by stop_at_known_releases() to spot edited releases
+RELEASE_CHANGE_COLUMNS = (
+    "tag_name",
+    "target_commitish",
+    "name",
+    "draft",
+    "prerelease",
+    "published_at",
+    "body",
+)
+# Results requested per page by paginate()
+PAGE_SIZE = 100
+# Pages of results to fetch at once when the total number of pages is known
+PAGE_PREFETCH = 4
+# Items fetch_for_repos() workers may fetch ahead of the thread saving them
+FETCH_AHEAD = PAGE_SIZE
+# Savers write this many records at a time, each batch in one transaction
+BATCH_SIZE = 100
+# Buffered users are written with upsert_all() once this many are pending
+USER_BATCH_SIZE = 100
+# Below this many remaining requests, pace them evenly until the limit resets
+RATE_LIMIT_LOW_WATER = 100
+# Times to retry a request that hit a primary or secondary rate limit
+MAX_RATE_LIMIT_RETRIES = 5
+# Seconds between pages of scraped github.com HTML: this shrinks towards the
+# minimum while pages come back fine and doubles each time we get a 429
+SCRAPE_DELAY = 1.0
+SCRAPE_MIN_DELAY = 0.25
+SCRAPE_MAX_DELAY = 60
+
+_session = None
+_session_lock = threading.Lock()
+# Per-Database state (caches, buffered writes) for the current run
+_run_states = weakref.WeakKeyDictionary()
+
+
+class RateLimiter:
+    """
+    Paces requests using the X-RateLimit-* headers GitHub sends back, tracked
+    separately for each token and rate limit resource (core, search, graphql).
+
+    Requests go out as fast as they are made while there is plenty of budget
+    left. Once fewer than low_water requests remain they are spread evenly
+    over the rest of the window, and when none remain we sleep until reset.
+    """
+
+    def __init__(self, low_water=RATE_LIMIT_LOW_WATER):
+        self.lock = threading.Lock()
+        self.low_water = low_water
+        self.limits = {}
+
+    def acquire(self, key):
+        "Block until we can make another request against this limit"
+        while True:
+            with self.lock:
+                delay = self._reserve(key, time.time())
+            if not delay:
+                return
+            time.sleep(delay)
+
+    def _reserve(self, key, now):
+        limit = self.limits.get(key)
+        if limit is None or limit["reset"] <= now:
+            # Unknown, or the window has reset since we last heard
+            return 0
+        if limit["remaining"] <= 0:
+            return limit["reset"] - now + 1
+        if limit["next_at"] > now:
+            return limit["next_at"] - now
+        limit["remaining"] -= 1
+        if limit["remaining"] < self.low_water:
+            limit["next_at"] = now + (limit["reset"] - now) / max(limit["remaining"], 1)
+        return 0
+
+    def choose(self, keys):
+        "The key with the most requests left - unknown limits count as unused"
+        now = time.time()
+        with self.lock:
+
+            def headroom(key):
+                limit = self.limits.get(key)
+                if limit is None or limit["reset"] <= now:
+                    return float("inf")
+                return limit["remaining"]
+
+            return max(keys, key=headroom)
+
+    def update(self, key, response):
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        reset = response.headers.get("X-RateLimit-Reset")
+        if remaining is None or reset is None:
+            return
+        with self.lock:
+            limit = self.limits.setdefault(key, {"next_at": 0})
+            limit["remaining"] = int(remaining)
+            limit["reset"] = int(reset)
+
+
+class GitHubSession(requests.Session):
+    "A requests.Session that paces API calls and retries when rate limited"
+
+    def __init__(self, rate_limiter=None):
+        super().__init__()
+        self.rate_limiter = rate_limiter or RateLimiter()
+        # Requests made with any of these tokens can be sent with any other
+        self.tokens = []
+
+    def request(self, method, url, *args, **kwargs):
+        key = self.rate_limit_key(url, kwargs.get("headers"))
+        if key is None:
+            return super().request(method, url, *args, **kwargs)
+        attempt = 0
+        while True:
+            key = self.choose_token(key, kwargs)
+            self.rate_limiter.acquire(key)
+            response = super().request(method, url, *args, **kwargs)
+            self.rate_limiter.update(key, response)
+            delay = rate_limit_retry_delay(response, attempt)
+            if delay is None or attempt >= MAX_RATE_LIMIT_RETRIES:
+                return response
+            attempt += 1
+            time.sleep(delay)
+
+    def choose_token(self, key, kwargs):
+        "Switch a pooled token for the one with the most headroom left"
+        authorization, resource = key
+        pool = ["token {}".format(token) for token in self.tokens]
+        if authorization not in pool:
+            return key
+        key = self.rate_limiter.choose([(auth, resource) for auth in pool])
+        headers = {
+            name: value
+            for name, value in (kwargs.get("headers") or {}).items()
+            if name.lower() != "authorization"
+        }
+        headers["Authorization"] = key[0]
+        kwargs["headers"] = headers
+        return key
+
+    def rate_limit_key(self, url, headers=None):
+        "Returns (authorization, resource) for API URLs, None for anything else"
+        parsed = urllib.parse.urlparse(url)
+        if parsed.hostname != "api.github.com":
+            return None
+        if parsed.path.startswith("/search/"):
+            resource = "search"
+        elif parsed.path.startswith("/graphql"):
+            resource = "graphql"
+        else:
+            resource = "core"
+        merged = requests.structures.CaseInsensitiveDict(self.headers)
+        merged.update(headers or {})
+        return (merged.get("Authorization"), resource)
+
+
+def rate_limit_retry_delay(response, attempt):
+    "Seconds to wait before retrying a rate limited response, None if it was not"
+    if response.status_code not in (403, 429):
+        return None
+    retry_after = response.headers.get("Retry-After")
+    if retry_after and retry_after.isdigit():
+        return int(retry_after)
+    if response.headers.get("X-RateLimit-Remaining") == "0":
+        # Primary rate limit: RateLimiter.acquire() will sleep until reset
+        return 0
+    if response.status_code == 429 or "secondary rate limit" in response.text.lower():
+        # GitHub ask for at least a minute between retries
+        return 60 * 2**attempt
+    return None
+
+
+class HttpCache:
+    """
+    ETag and Last-Modified validators for URLs we have fetched before, stored
+    in the _http_cache table of the database we are writing to.
+
+    Validators for new responses are held in memory until save() is called,
+    which should only happen once the data they describe has been saved.
+
+    Repositories fetched less than repo_max_age seconds ago are not requested
+    again at all - see fetch_repo().
+
+    Saved bodies can be whole repositories and READMEs, so load() leaves them
+    out and body() reads them when they are needed.
+    """
+
+    def __init__(self, entries=None, repo_max_age=None, conn=None):
+        self.lock = threading.Lock()
+        self.entries = entries or {}
+        self.pending = {}
+        self.repo_max_age = repo_max_age
+        self.conn = conn
+
+    @classmethod
+    def load(cls, db, repo_max_age=None):
+        entries = {}
+        conn = None
+        table = db["_http_cache"]
+        if table.exists():
+            filename = db.execute("pragma database_list").fetchone()[2]
+            select = "*"
+            if filename:
+                # Bodies are read from worker threads, which can't use db.conn
+                conn = sqlite3.connect(filename, check_same_thread=False)
+                columns = [
+                    "[{}]".format(column)
+                    for column in table.columns_dict
+                    if column != "body"
+                ]
+                select = ", ".join(columns + ["body is not null as has_body"])
+            for row in db.query("select {} from _http_cache".format(select)):
+                entries[(row["url"], row["accept"])] = row
+        return cls(entries, repo_max_age, conn)
+
+    @staticmethod
+    def key(url, headers):
+        accept = requests.structures.CaseInsensitiveDict(headers or {}).get("accept")
+        return (url, accept or "")
+
+    def get(self, url, headers=None):
+        key = self.key(url, headers)
+        with self.lock:
+            return self.pending.get(key) or self.entries.get(key)
+
+    def fresh(self, url, headers, max_age):
+        "The cached entry for url if it has a body fetched within max_age seconds"
+        cached = self.get(url, headers)
+        if (
+            max_age
+            and cached
+            and self.has_body(cached)
+            and (cached.get("fetched_at") or 0) > time.time() - max_age
+        ):
+            return cached
+        return None
+
+    @staticmethod
+    def has_body(cached):
+        if "body" in cached:
+            return cached["body"] is not None
+        return bool(cached["has_body"])
+
+    def body(self, cached):
+        "The body saved with a cached entry, read from the database if needed"
+        if "body" in cached:
+            return cached["body"]
+        if not cached["has_body"]:
+            return None
+        with self.lock:
+            row = self.conn.execute(
+                "select body from _http_cache where url = ? and accept = ?",
+                (cached["url"], cached["accept"]),
+            ).fetchone()
+        return row[0] if row else None
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def store(self, url, headers, response, next_url=None, body=None, full=None):
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if not etag and not last_modified:
+            return
+        key = self.key(url, headers)
+        with self.lock:
+            self.pending[key] = {
+                "url": key[0],
+                "accept": key[1],
+                "etag": etag,
+                "last_modified": last_modified,
+                "next_url": next_url,
+                "full": full,
+                "body": body,
+                "fetched_at": time.time(),
+            }
+
+    def discard(self, prefix):
+        "Forget validators not yet saved for URLs starting with prefix"
+        with self.lock:
+            self.pending = {
+                key: entry
+                for key, entry in self.pending.items()
+                if not key[0].startswith(prefix)
+            }
+
+    def save(self, db):
+        with self.lock:
+            pending = list(self.pending.values())
+            self.entries.update(self.pending)
+            self.pending = {}
+        if pending:
+            db["_http_cache"].upsert_all(pending, pk=("url", "accept"), alter=True)
+
 
 class GitHubError(Exception):
     def __init__(self, message, status_code, headers=None):
@@ -92,68 +512,181 @@ class GitHubRepositoryEmpty(GitHubError):
     pass
 
 
+@contextlib.contextmanager
+def buffered_users(db):
+    """
+    Buffer users passed to save_user() within this block, writing them with
+    upsert_all() in batches and always flushing the rest at the end
+    """
+    state = run_state(db)
+    depth = state.get("users_buffer_depth", 0)
+    state["users_buffer_depth"] = depth + 1
+    try:
+        yield
+    finally:
+        state["users_buffer_depth"] = depth
+        if not depth:
+            flush_users(db)
+
+
+def buffers_users(fn):
+    "Run a save_* function inside buffered_users()"
+
+    @functools.wraps(fn)
+    def wrapper(db, *args, **kwargs):
+        with buffered_users(db):
+            return fn(db, *args, **kwargs)
+
+    return wrapper
+
+
+@buffers_users
 def save_issues(db, issues, repo):
-    if "milestones" not in db.table_names():
-        if "users" not in db.table_names():
-            # So we can define the foreign key from milestones:
-            db["users"].create({"id": int}, pk="id")
-        db["milestones"].create(
-            {"id": int, "title": str, "description": str, "creator": int, "repo": int},
-            pk="id",
-            foreign_keys=(("repo", "repos", "id"), ("creator", "users", "id")),
-        )
-    for original in issues:
-        # Ignore all of the _url fields
-        issue = {
-            key: value for key, value in original.items() if not key.endswith("url")
-        }
-        # Add repo key
-        issue["repo"] = repo["id"]
-        # Pull request can be flattened to just their URL
-        if issue.get("pull_request"):
-            issue["pull_request"] = issue["pull_request"]["url"].split(
-                "https://api.github.com/repos/"
-            )[1]
-        # Extract user
-        issue["user"] = save_user(db, issue["user"])
-        labels = issue.pop("labels")
-        # Extract milestone
-        if issue["milestone"]:
-            issue["milestone"] = save_milestone(db, issue["milestone"], repo["id"])
-        # For the moment we ignore the assignees=[] array but we DO turn assignee
-        # singular into a foreign key reference
-        issue.pop("assignees", None)
-        if issue["assignee"]:
-            issue["assignee"] = save_user(db, issue["assignee"])
-        # Add a type field to distinguish issues from pulls
-        issue["type"] = "pull" if issue.get("pull_request") else "issue"
-        # Insert record
-        table = db["issues"].insert(
-            issue,
-            pk="id",
-            foreign_keys=[
-                ("user", "users", "id"),
-                ("assignee", "users", "id"),
-                ("milestone", "milestones", "id"),
-                ("repo", "repos", "id"),
-            ],
-            alter=True,
-            replace=True,
-            columns={
-                "user": int,
-                "assignee": int,
-                "milestone": int,
-                "repo": int,
-                "title": str,
-                "body": str,
-            },
-        )
-        # m2m for labels
-        for label in labels:
-            table.m2m("labels", label, pk="id")
+    ensure_milestones_table(db)
+    for batch in batches(issues, get_batch_size(db)):
+        rows = []
+        milestones = {}
+        labels = {}
+        label_links = []
+        for original in batch:
+            # Ignore all of the _url fields
+            issue = {
+                key: value for key, value in original.items() if not key.endswith("url")
+            }
+            # Add repo key
+            issue["repo"] = repo["id"]
+            # Pull request can be flattened to just their URL
+            if issue.get("pull_request"):
+                issue["pull_request"] = issue["pull_request"]["url"].split(
+                    "https://api.github.com/repos/"
+                )[1]
+            # Extract user
+            issue["user"] = save_user(db, issue["user"])
+            # Extract milestone
+            if issue["milestone"]:
+                milestone = milestone_row(db, issue["milestone"], repo["id"])
+                milestones[milestone["id"]] = milestone
+                issue["milestone"] = milestone["id"]
+            # For the moment we ignore the assignees=[] array but we DO turn assignee
+            # singular into a foreign key reference
+            issue.pop("assignees", None)
+            if issue["assignee"]:
+                issue["assignee"] = save_user(db, issue["assignee"])
+            # Add a type field to distinguish issues from pulls
+            issue["type"] = "pull" if issue.get("pull_request") else "issue"
+            # m2m for labels
+            for label in issue.pop("labels"):
+                labels[label["id"]] = label
+                label_links.append({"labels_id": label["id"], "issues_id": issue["id"]})
+            rows.append(issue)
+        flush_users(db)
+        with transaction(db):
+            save_milestones(db, milestones.values())
+            prepare_fts_write(db, "issues")
+            db["issues"].insert_all(
+                rows,
+                pk="id",
+                foreign_keys=[
+                    ("user", "users", "id"),
+                    ("assignee", "users", "id"),
+                    ("milestone", "milestones", "id"),
+                    ("repo", "repos", "id"),
+                ],
+                alter=True,
+                replace=True,
+                columns={
+                    "user": int,
+                    "assignee": int,
+                    "milestone": int,
+                    "repo": int,
+                    "title": str,
+                    "body": str,
+                },
+            )
+            save_labels(db, "issues", labels.values(), label_links)
 
 
+@buffers_users
 def save_pull_requests(db, pull_requests, repo):
+    ensure_milestones_table(db)
+    for batch in batches(pull_requests, get_batch_size(db)):
+        rows = []
+        milestones = {}
+        labels = {}
+        label_links = []
+        for original in batch:
+            # Ignore all of the _url fields
+            pull_request = {
+                key: value for key, value in original.items() if not key.endswith("url")
+            }
+            # Add repo key
+            pull_request["repo"] = repo["id"]
+            # Pull request _links can be flattened to just their URL
+            if "_links" in pull_request:
+                pull_request["url"] = pull_request["_links"]["html"]["href"]
+                pull_request.pop("_links")
+            else:
+                pull_request["url"] = pull_request["pull_request"]["html_url"]
+            # Extract user
+            pull_request["user"] = save_user(db, pull_request["user"])
+            # Extract merged_by, if it exists
+            if pull_request.get("merged_by"):
+                pull_request["merged_by"] = save_user(db, pull_request["merged_by"])
+            # Head sha
+            if "head" in pull_request:
+                pull_request["head"] = pull_request["head"]["sha"]
+                pull_request["base"] = pull_request["base"]["sha"]
+            # Extract milestone
+            if pull_request["milestone"]:
+                milestone = milestone_row(db, pull_request["milestone"], repo["id"])
+                milestones[milestone["id"]] = milestone
+                pull_request["milestone"] = milestone["id"]
+            # For the moment we ignore the assignees=[] array but we DO turn assignee
+            # singular into a foreign key reference
+            pull_request.pop("assignees", None)
+            if original["assignee"]:
+                pull_request["assignee"] = save_user(db, pull_request["assignee"])
+            pull_request.pop("active_lock_reason")
+            # ignore requested_reviewers and requested_teams
+            pull_request.pop("requested_reviewers", None)
+            pull_request.pop("requested_teams", None)
+            # m2m for labels
+            for label in pull_request.pop("labels"):
+                labels[label["id"]] = label
+                label_links.append(
+                    {"labels_id": label["id"], "pull_requests_id": pull_request["id"]}
+                )
+            rows.append(pull_request)
+        flush_users(db)
+        with transaction(db):
+            save_milestones(db, milestones.values())
+            prepare_fts_write(db, "pull_requests")
+            db["pull_requests"].insert_all(
+                rows,
+                pk="id",
+                foreign_keys=[
+                    ("user", "users", "id"),
+                    ("merged_by", "users", "id"),
+                    ("assignee", "users", "id"),
+                    ("milestone", "milestones", "id"),
+                    ("repo", "repos", "id"),
+                ],
+                alter=True,
+                replace=True,
+                columns={
+                    "user": int,
+                    "assignee": int,
+                    "milestone": int,
+                    "repo": int,
+                    "title": str,
+                    "body": str,
+                    "merged_by": int,
+                },
+            )
+            save_labels(db, "pull_requests", labels.values(), label_links)
+
+
+def ensure_milestones_table(db):
     if "milestones" not in db.table_names():
         if "users" not in db.table_names():
             # So we can define the foreign key from milestones:
@@ -163,69 +696,23 @@ def save_pull_requests(db, pull_requests, repo):
             pk="id",
             foreign_keys=(("repo", "repos", "id"), ("creator", "users", "id")),
         )
-    for original in pull_requests:
-        # Ignore all of the _url fields
-        pull_request = {
-            key: value for key, value in original.items() if not key.endswith("url")
-        }
-        # Add repo key
-        pull_request["repo"] = repo["id"]
-        # Pull request _links can be flattened to just their URL
-        if "_links" in pull_request:
-            pull_request["url"] = pull_request["_links"]["html"]["href"]
-            pull_request.pop("_links")
-        else:
-            pull_request["url"] = pull_request["pull_request"]["html_url"]
-        # Extract user
-        pull_request["user"] = save_user(db, pull_request["user"])
-        labels = pull_request.pop("labels")
-        # Extract merged_by, if it exists
-        if pull_request.get("merged_by"):
-            pull_request["merged_by"] = save_user(db, pull_request["merged_by"])
-        # Head sha
-        if "head" in pull_request:
-            pull_request["head"] = pull_request["head"]["sha"]
-            pull_request["base"] = pull_request["base"]["sha"]
-        # Extract milestone
-        if pull_request["milestone"]:
-            pull_request["milestone"] = save_milestone(
-                db, pull_request["milestone"], repo["id"]
-            )
-        # For the moment we ignore the assignees=[] array but we DO turn assignee
-        # singular into a foreign key reference
-        pull_request.pop("assignees", None)
-        if original["assignee"]:
-            pull_request["assignee"] = save_user(db, pull_request["assignee"])
-        pull_request.pop("active_lock_reason")
-        # ignore requested_reviewers and requested_teams
-        pull_request.pop("requested_reviewers", None)
-        pull_request.pop("requested_teams", None)
-        # Insert record
-        table = db["pull_requests"].insert(
-            pull_request,
-            pk="id",
-            foreign_keys=[
-                ("user", "users", "id"),
-                ("merged_by", "users", "id"),
-                ("assignee", "users", "id"),
-                ("milestone", "milestones", "id"),
-                ("repo", "repos", "id"),
-            ],
-            alter=True,
-            replace=True,
-            columns={
-                "user": int,
-                "assignee": int,
-                "milestone": int,
-                "repo": int,
-                "title": str,
-                "body": str,
-                "merged_by": int,
-            },
-        )
-        # m2m for labels
-        for label in labels:
-            table.m2m("labels", label, pk="id")
+
+
+def save_labels(db, table, labels, links):
+    "Save labels plus the many-to-many rows linking them to issues or pull_requests"
+    labels = list(labels)
+    if not labels:
+        return
+    prepare_fts_write(db, "labels")
+    db["labels"].insert_all(labels, pk="id", replace=True)
+    # Same table name, primary key and foreign keys that table.m2m() would use
+    tables = sorted([table, "labels"])
+    db["_".join(tables)].insert_all(
+        links,
+        pk=tuple("{}_id".format(t) for t in tables),
+        foreign_keys=[("{}_id".format(t), t, "id") for t in ("labels", table)],
+        replace=True,
+    )
 
 
 def save_user(db, user):
@@ -244,49 +731,177 @@ def save_user(db, user):
     # so fill in 'name' from 'login' so Datasette foreign keys display
     if to_save.get("name") is None:
         to_save["name"] = to_save["login"]
-    return db["users"].upsert(to_save, pk="id", alter=True).last_pk
+    # The same users show up over and over again (issue authors, repo owners)
+    # so skip any we have already seen with identical content this run
+    state = run_state(db)
+    seen = state.setdefault("users_seen", {})
+    pending = state.setdefault("users_pending", {})
+    user_id = to_save["id"]
+    fingerprint = hash(json.dumps(to_save, sort_keys=True, default=str))
+    if seen.get(user_id) == fingerprint:
+        return user_id
+    seen[user_id] = fingerprint
+    if user_id in pending:
+        pending[user_id].update(to_save)
+    else:
+        pending[user_id] = to_save
+    if not state.get("users_table_exists"):
+        state["users_table_exists"] = db["users"].exists()
+    if (
+        not state.get("users_buffer_depth")
+        or len(pending) >= USER_BATCH_SIZE
+        or not state["users_table_exists"]
+    ):
+        # Written straight away outside of buffered_users(), and the first
+        # user always is so other tables can reference the table
+        flush_users(db)
+    return user_id
+
+
+def flush_users(db):
+    "Write any users buffered by save_user() to the users table"
+    state = run_state(db)
+    pending = state.get("users_pending")
+    if not pending:
+        return
+    prepare_fts_write(db, "users")
+    # upsert_all() sets every column in a batch, so users nested in other
+    # objects (with fewer keys) are written separately from full users to
+    # avoid overwriting their existing columns with null
+    for _, users in itertools.groupby(pending.values(), key=lambda u: tuple(sorted(u))):
+        db["users"].upsert_all(list(users), pk="id", alter=True)
+    pending.clear()
+    state["users_table_exists"] = True
+
+
+def batches(iterable, size):
+    "Yield lists of up to size items from iterable, consuming it lazily"
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def iter_json_items(fp, chunk_size=64 * 1024):
+    """
+    Yield the items in a JSON array, or in newline-delimited JSON, reading
+    fp a chunk at a time so the whole file never has to be held in memory
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+    in_array = None
+    while True:
+        # Skip whitespace, plus the commas and closing bracket of an array
+        separators = " \t\r\n,]" if in_array else " \t\r\n"
+        while pos < len(buffer) and buffer[pos] in separators:
+            pos += 1
+        if pos < len(buffer) and in_array is None:
+            in_array = buffer[pos] == "["
+            pos += in_array
+            continue
+        end = None
+        if pos < len(buffer):
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+        # Read more unless we have a value that is definitely complete
+        if end is None or (end == len(buffer) and not eof):
+            if eof:
+                return
+            buffer, pos = buffer[pos:], 0
+            chunk = fp.read(chunk_size)
+            buffer += chunk
+            eof = not chunk
+            continue
+        yield item
+        pos = end
+
+
+@contextlib.contextmanager
+def transaction(db):
+    "Run a block of writes in a single transaction"
+    # atomic() nests safely with the transactions sqlite-utils opens for
+    # each of its own writes, so the whole block commits once
+    with db.atomic():
+        yield
+
 
+def run_state(db):
+    "Return a dictionary of state for this database that lasts for the current run"
+    return _run_states.setdefault(db, {})
 
+
+def get_batch_size(db):
+    return run_state(db).get("batch_size") or BATCH_SIZE
+
+
+def configure_db(
+    db, wal=False, synchronous=None, batch_size=None, cache_size=None, mmap_size=None
+):
+    "Apply journal mode, pragmas and write batch size for bulk ingestion"
+    if wal:
+        db.enable_wal()
+        # NORMAL is durable in WAL mode and avoids an fsync per transaction
+        synchronous = synchronous or "NORMAL"
+    if synchronous:
+        db.conn.execute("PRAGMA synchronous = {}".format(synchronous.upper()))
+    if cache_size:
+        # Negative values are in KiB rather than pages
+        db.conn.execute("PRAGMA cache_size = -{}".format(int(cache_size)))
+    if mmap_size:
+        db.conn.execute("PRAGMA mmap_size = {}".format(int(mmap_size)))
+    if batch_size:
+        run_state(db)["batch_size"] = batch_size
+    return db
+
+
+@buffers_users
 def save_milestone(db, milestone, repo_id):
+    milestone = milestone_row(db, milestone, repo_id)
+    save_milestones(db, [milestone])
+    return milestone["id"]
+
+
+def milestone_row(db, milestone, repo_id):
     milestone = dict(milestone)
     milestone["creator"] = save_user(db, milestone["creator"])
     milestone["repo"] = repo_id
     milestone.pop("labels_url", None)
     milestone.pop("url", None)
-    return (
-        db["milestones"]
-        .insert(
-            milestone,
-            pk="id",
-            foreign_keys=[("creator", "users", "id"), ("repo", "repos", "id")],
-            alter=True,
-            replace=True,
-            columns={"creator": int, "repo": int},
-        )
-        .last_pk
+    return milestone
+
+
+def save_milestones(db, milestones):
+    prepare_fts_write(db, "milestones")
+    db["milestones"].insert_all(
+        milestones,
+        pk="id",
+        foreign_keys=[("creator", "users", "id"), ("repo", "repos", "id")],
+        alter=True,
+        replace=True,
+        columns={"creator": int, "repo": int},
     )
 
 
+@buffers_users
 def save_issue_comment(db, comment):
-    comment = dict(comment)
-    comment["user"] = save_user(db, comment["user"])
-    # We set up a 'issue' foreign key, but only if issue is in the DB
-    comment["issue"] = None
-    issue_url = comment["issue_url"]
-    bits = issue_url.split("/")
-    user_slug, repo_slug, issue_number = bits[-4], bits[-3], bits[-1]
+    comment, (repo, number) = issue_comment_row(db, comment)
     # Is the issue in the DB already?
     issue_rows = list(
         db["issues"].rows_where(
             "number = :number and repo = (select id from repos where full_name = :repo)",
-            {"repo": "{}/{}".format(user_slug, repo_slug), "number": issue_number},
+            {"repo": repo, "number": number},
         )
     )
     if len(issue_rows) == 1:
         comment["issue"] = issue_rows[0]["id"]
-    comment.pop("url", None)
-    if "url" in comment.get("reactions", {}):
-        comment["reactions"].pop("url")
+    prepare_fts_write(db, "issue_comments")
     last_pk = (
         db["issue_comments"]
         .insert(
@@ -297,19 +912,105 @@ def save_issue_comment(db, comment):
     return last_pk
 
 
-def fetch_repo(full_name=None, token=None, url=None):
+@buffers_users
+def save_issue_comments(db, comments, issue_ids=None):
+    "Save comments in batches, resolving their issues against an in-memory map"
+    if issue_ids is None:
+        issue_ids = load_issue_ids(db)
+    for batch in batches(comments, get_batch_size(db)):
+        rows = []
+        for comment in batch:
+            comment, key = issue_comment_row(db, comment)
+            comment["issue"] = issue_ids.get(key)
+            rows.append(comment)
+        flush_users(db)
+        with transaction(db):
+            prepare_fts_write(db, "issue_comments")
+            db["issue_comments"].insert_all(
+                rows,
+                pk="id",
+                foreign_keys=("user", "issue"),
+                alter=True,
+                replace=True,
+            )
+
+
+def issue_comment_row(db, comment):
+    "Prepare a comment for saving, returning it with its issue's (repo, number)"
+    comment = dict(comment)
+    comment["user"] = save_user(db, comment["user"])
+    # We set up a 'issue' foreign key, but only if issue is in the DB
+    comment["issue"] = None
+    issue_url = comment["issue_url"]
+    bits = issue_url.split("/")
+    user_slug, repo_slug, issue_number = bits[-4], bits[-3], bits[-1]
+    comment.pop("url", None)
+    if "url" in comment.get("reactions", {}):
+        comment["reactions"].pop("url")
+    return comment, ("{}/{}".format(user_slug, repo_slug), int(issue_number))
+
+
+def load_commit_shas(db):
+    "Set of every commit SHA already saved, from any repo"
+    if not db["commits"].exists():
+        return set()
+    return {row[0] for row in db.execute("select sha from commits")}
+
+
+def load_issue_ids(db, repo=None):
+    "Map (repo full_name, issue number) to issue id, for one repo or all of them"
+    if not {"issues", "repos"}.issubset(db.table_names()):
+        return {}
+    sql = (
+        "select repos.full_name, issues.number, issues.id "
+        "from issues join repos on issues.repo = repos.id"
+    )
+    params = []
+    if repo is not None:
+        # The repo as typed on the command line may differ in case
+        sql += " where repos.full_name = ? collate nocase"
+        params.append(repo)
+    return {
+        (full_name, number): id for full_name, number, id in db.execute(sql, params)
+    }
+
+
+def fetch_repo(full_name=None, token=None, url=None, max_age=None):
+    """
+    max_age is how old, in seconds, a cached copy of the repo can be before
+    it is requested again. It defaults to the http cache's repo_max_age.
+    """
     headers = make_headers(token)
     # Get topics:
     headers["Accept"] = "application/vnd.github.mercy-preview+json"
     if url is None:
         owner, slug = full_name.split("/")
         url = "https://api.github.com/repos/{}/{}".format(owner, slug)
-    response = requests.get(url, headers=headers)
+    cache = getattr(get_session(), "http_cache", None)
+    if cache is not None:
+        fresh = cache.fresh(
+            url, headers, cache.repo_max_age if max_age is None else max_age
+        )
+        if fresh:
+            return json.loads(cache.body(fresh))
+    response, cached = conditional_get(url, headers)
+    if response.status_code == 304:
+        # Unchanged - store it again to restart the max_age clock
+        body = cache.body(cached)
+        store_http_cache(url, headers, response, body=body)
+        return json.loads(body)
     response.raise_for_status()
+    store_http_cache(url, headers, response, body=response.text)
     return response.json()
 
 
+@buffers_users
 def save_repo(db, repo):
+    repo_id = save_repos(db, [repo_row(db, repo)])[0]
+    return repo_id
+
+
+def repo_row(db, repo):
     assert isinstance(repo, dict), "Repo should be a dict: {}".format(repr(repo))
     # Remove all url fields except html_url
     to_save = {
@@ -323,48 +1024,62 @@ def save_repo(db, repo):
         to_save["organization"] = save_user(db, to_save["organization"])
     else:
         to_save["organization"] = None
-    repo_id = (
-        db["repos"]
-        .insert(
-            to_save,
-            pk="id",
-            foreign_keys=(("owner", "users", "id"), ("organization", "users", "id")),
-            alter=True,
-            replace=True,
-            columns={
-                "organization": int,
-                "topics": str,
-                "name": str,
-                "description": str,
-            },
-        )
-        .last_pk
+    return to_save
+
+
+def save_repos(db, repos):
+    "Write rows from repo_row() in one go, returning their ids"
+    prepare_fts_write(db, "repos")
+    db["repos"].insert_all(
+        repos,
+        pk="id",
+        foreign_keys=(("owner", "users", "id"), ("organization", "users", "id")),
+        alter=True,
+        replace=True,
+        columns={
+            "organization": int,
+            "topics": str,
+            "name": str,
+            "description": str,
+        },
     )
-    return repo_id
+    return [repo["id"] for repo in repos]
 
 
 def save_license(db, license):
     if license is None:
         return None
-    return db["licenses"].insert(license, pk="key", replace=True).last_pk
-
-
-def fetch_issues(repo, token=None, issue_ids=None):
+    # A handful of licenses are shared by most repos, only write each one
+    # again if it has changed since we last saw it this run
+    seen = run_state(db).setdefault("licenses_seen", {})
+    fingerprint = json.dumps(license, sort_keys=True, default=str)
+    if seen.get(license["key"]) != fingerprint:
+        prepare_fts_write(db, "licenses")
+        db["licenses"].insert(license, pk="key", replace=True)
+        seen[license["key"]] = fingerprint
+    return license["key"]
+
+
+def fetch_issues(repo, token=None, issue_ids=None, since=None):
     headers = make_headers(token)
     headers["accept"] = "application/vnd.github.v3+json"
     if issue_ids:
         for issue_id in issue_ids:
             url = "https://api.github.com/repos/{}/issues/{}".format(repo, issue_id)
-            response = requests.get(url, headers=headers)
+            response = get_session().get(url, headers=headers)
             response.raise_for_status()
             yield response.json()
     else:
         url = "https://api.github.com/repos/{}/issues?state=all&filter=all".format(repo)
-        for issues in paginate(url, headers):
+        if since:
+            url += "&" + urllib.parse.urlencode({"since": since})
+        for issues in paginate(url, headers, prefetch=PAGE_PREFETCH):
             yield from issues
 
 
-def fetch_pull_requests(repo, state=None, token=None, pull_request_ids=None):
+def fetch_pull_requests(
+    repo, state=None, token=None, pull_request_ids=None, since=None
+):
     headers = make_headers(token)
     headers["accept"] = "application/vnd.github.v3+json"
     if pull_request_ids:
@@ -372,14 +1087,21 @@ def fetch_pull_requests(repo, state=None, token=None, pull_request_ids=None):
             url = "https://api.github.com/repos/{}/pulls/{}".format(
                 repo, pull_request_id
             )
-            response = requests.get(url, headers=headers)
+            response = get_session().get(url, headers=headers)
             response.raise_for_status()
             yield response.json()
     else:
         state = state or "all"
         url = f"https://api.github.com/repos/{repo}/pulls?state={state}"
-        for pull_requests in paginate(url, headers):
-            yield from pull_requests
+        if since:
+            # The pulls API has no since= parameter, so fetch the most recently
+            # updated first and stop once we reach older ones
+            url += "&sort=updated&direction=desc"
+        for pull_requests in paginate(url, headers, stop_if_unchanged=bool(since)):
+            for pull_request in pull_requests:
+                if since and pull_request["updated_at"] < since:
+                    return
+                yield pull_request
 
 
 def fetch_searched_pulls_or_issues(query, token=None):
@@ -390,7 +1112,7 @@ def fetch_searched_pulls_or_issues(query, token=None):
         yield from pulls_or_issues["items"]
 
 
-def fetch_issue_comments(repo, token=None, issue=None):
+def fetch_issue_comments(repo, token=None, issue=None, since=None):
     assert "/" in repo
     headers = make_headers(token)
     # Get reactions:
@@ -399,15 +1121,212 @@ def fetch_issue_comments(repo, token=None, issue=None):
     if issue is not None:
         path = "/repos/{}/issues/{}/comments".format(repo, issue)
     url = "https://api.github.com{}".format(path)
+    if since:
+        url += "?" + urllib.parse.urlencode({"since": since})
     for comments in paginate(url, headers):
         yield from comments
 
 
-def fetch_releases(repo, token=None):
+def fetch_issues_graphql(repo, token, since=None):
+    """
+    Yield (issue, comments) for every issue in repo using the GraphQL API,
+    which returns labels, assignees and comments nested inside each page of
+    issues. Both are mapped to the shapes the REST API returns so they can be
+    passed to save_issues() and save_issue_comments().
+    """
+    owner, name = repo.split("/")
+    # GraphQL labels and milestones have no REST ids, so look those up. These
+    # are needed in full on every run, so they are not conditional requests
+    headers = make_headers(token)
+    labels = {}
+    url = "https://api.github.com/repos/{}/labels".format(repo)
+    for page in paginate(url, headers, conditional=False):
+        labels.update((label["name"], label) for label in page)
+    milestones = {}
+    url = "https://api.github.com/repos/{}/milestones?state=all".format(repo)
+    for page in paginate(url, headers, conditional=False):
+        milestones.update((milestone["number"], milestone) for milestone in page)
+
+    variables = {
+        "owner": owner,
+        "name": name,
+        "first": graphql_issues_page_size(),
+        "after": None,
+        "comments": GRAPHQL_COMMENTS_PER_ISSUE,
+        "since": since,
+    }
+    while True:
+        try:
+            data = graphql(GRAPHQL_ISSUES_QUERY, variables, token)
+        except GitHubError as e:
+            # Large pages can time out on GitHub's side - try a smaller one
+            if e.status_code in (502, 504) and variables["first"] > 1:
+                variables["first"] //= 2
+                continue
+            raise
+        issues = data["repository"]["issues"]
+        for node in issues["nodes"]:
+            issue = graphql_issue(node, repo, labels, milestones)
+            comments = node["comments"]
+            comment_nodes = list(comments["nodes"])
+            after = comments["pageInfo"]["endCursor"]
+            while comments["pageInfo"]["hasNextPage"]:
+                comments = graphql(
+                    GRAPHQL_COMMENTS_QUERY, {"id": node["id"], "after": after}, token
+                )["node"]["comments"]
+                comment_nodes.extend(comments["nodes"])
+                after = comments["pageInfo"]["endCursor"]
+            yield issue, [
+                graphql_issue_comment(comment, repo, node["number"])
+                for comment in comment_nodes
+            ]
+        if not issues["pageInfo"]["hasNextPage"]:
+            return
+        variables["after"] = issues["pageInfo"]["endCursor"]
+
+
+def graphql(query, variables, token):
+    "Run a GraphQL query and return its data, raising GitHubError on errors"
+    response = get_session().post(
+        "https://api.github.com/graphql",
+        json={"query": query, "variables": variables},
+        headers=make_headers(token),
+    )
+    try:
+        body = response.json()
+    except ValueError:
+        raise GitHubError(response.text, response.status_code, response.headers)
+    errors = body.get("errors") or ([body] if response.status_code != 200 else None)
+    if errors:
+        raise GitHubError(
+            "; ".join(error.get("message", "") for error in errors),
+            response.status_code,
+            response.headers,
+        )
+    return body["data"]
+
+
+def graphql_issues_page_size(comments=None, budget=None):
+    "Issues per query that keeps the number of nodes requested within budget"
+    comments = GRAPHQL_COMMENTS_PER_ISSUE if comments is None else comments
+    budget = GRAPHQL_NODE_BUDGET if budget is None else budget
+    # Each issue asks for up to 10 assignees, 100 labels and its comments
+    return max(1, min(100, budget // (1 + 10 + 100 + comments)))
+
+
+def graphql_user(actor):
+    # Deleted users come back as null, as do accounts with no REST equivalent
+    if not actor or actor.get("databaseId") is None:
+        return None
+    return {
+        "login": actor["login"],
+        "id": actor["databaseId"],
+        "node_id": actor["id"],
+        "avatar_url": actor["avatarUrl"],
+        "html_url": actor["url"],
+        "type": actor["__typename"],
+    }
+
+
+def graphql_issue(node, repo, labels, milestones):
+    "Convert a GraphQL issue into the shape returned by the REST API"
+    assignees = [graphql_user(actor) for actor in node["assignees"]["nodes"]]
+    assignees = [assignee for assignee in assignees if assignee]
+    milestone = node["milestone"]
+    return {
+        "url": "https://api.github.com/repos/{}/issues/{}".format(repo, node["number"]),
+        "html_url": node["url"],
+        "id": node["databaseId"],
+        "node_id": node["id"],
+        "number": node["number"],
+        "title": node["title"],
+        "user": graphql_user(node["author"]),
+        "labels": [
+            labels[label["name"]]
+            for label in node["labels"]["nodes"]
+            if label["name"] in labels
+        ],
+        "state": node["state"].lower(),
+        "locked": node["locked"],
+        "assignee": assignees[0] if assignees else None,
+        "assignees": assignees,
+        "milestone": milestones.get(milestone["number"]) if milestone else None,
+        "comments": node["comments"]["totalCount"],
+        "created_at": node["createdAt"],
+        "updated_at": node["updatedAt"],
+        "closed_at": node["closedAt"],
+        "author_association": node["authorAssociation"],
+        "body": node["body"],
+    }
+
+
+def graphql_issue_comment(node, repo, number):
+    "Convert a GraphQL issue comment into the shape returned by the REST API"
+    reactions = {
+        GRAPHQL_REACTIONS[group["content"]]: group["reactors"]["totalCount"]
+        for group in node["reactionGroups"]
+        if group["content"] in GRAPHQL_REACTIONS
+    }
+    return {
+        "html_url": node["url"],
+        "issue_url": "https://api.github.com/repos/{}/issues/{}".format(repo, number),
+        "id": node["databaseId"],
+        "node_id": node["id"],
+        "user": graphql_user(node["author"]),
+        "created_at": node["createdAt"],
+        "updated_at": node["updatedAt"],
+        "author_association": node["authorAssociation"],
+        "body": node["body"],
+        "reactions": dict(total_count=sum(reactions.values()), **reactions),
+    }
+
+
+def fetch_releases(repo, token=None, stop_when=None):
     headers = make_headers(token)
     url = "https://api.github.com/repos/{}/releases".format(repo)
-    for releases in paginate(url, headers):
-        yield from releases
+    # Newest first, so like fetch_commits() stop_when can end an incremental
+    # fetch at the first release we already have
+    for releases in paginate(url, headers, stop_if_unchanged=stop_when is not None):
+        for release in releases:
+            if stop_when is not None and stop_when(release):
+                return
+            yield release
+
+
+def stop_at_known_releases(db, repos):
+    """
+    A stop_when for fetch_releases() that matches releases of these repos
+    ("owner/name") that are already saved and unchanged since, or None if
+    there are no saved releases
+    """
+    if not {"releases", "repos"}.issubset(db.table_names()):
+        return None
+    columns = [
+        column
+        for column in RELEASE_CHANGE_COLUMNS
+        if column in db["releases"].columns_dict
+    ]
+    # Loaded once, up front, so this can run in the fetching threads
+    sql = (
+        "select releases.id, {} from releases "
+        "join repos on releases.repo = repos.id "
+        "where repos.full_name collate nocase in ({})"
+    ).format(
+        ", ".join("releases.[{}]".format(column) for column in columns),
+        ", ".join("?" for _ in repos),
+    )
+    known = {row[0]: row[1:] for row in db.execute(sql, list(repos))}
+    if not known:
+        return None
+
+    def stop_when(release):
+        saved = known.get(release["id"])
+        return saved is not None and all(
+            saved_value == release.get(column)
+            for column, saved_value in zip(columns, saved)
+        )
+
+    return stop_when
 
 
 def fetch_contributors(repo, token=None):
@@ -424,13 +1343,24 @@ def fetch_tags(repo, token=None):
         yield from tags
 
 
-def fetch_commits(repo, token=None, stop_when=None):
+def fetch_commits(repo, token=None, stop_when=None, since=None, sha=None):
+    stop_when_given = stop_when is not None
     if stop_when is None:
         stop_when = lambda commit: False
     headers = make_headers(token)
     url = "https://api.github.com/repos/{}/commits".format(repo)
+    args = {key: value for key, value in (("sha", sha), ("since", since)) if value}
+    if args:
+        url += "?" + urllib.parse.urlencode(args)
     try:
-        for commits in paginate(url, headers):
+        # An unchanged first page means there are no new commits at all.
+        # Prefetching would waste requests on pages past the first known one
+        for commits in paginate(
+            url,
+            headers,
+            stop_if_unchanged=stop_when_given,
+            prefetch=1 if stop_when_given else PAGE_PREFETCH,
+        ):
             for commit in commits:
                 if stop_when(commit):
                     return
@@ -448,7 +1378,7 @@ def fetch_all_starred(username=None, token=None):
         url = "https://api.github.com/users/{}/starred".format(username)
     else:
         url = "https://api.github.com/user/starred"
-    for stars in paginate(url, headers):
+    for stars in paginate(url, headers, prefetch=PAGE_PREFETCH):
         yield from stars
 
 
@@ -456,11 +1386,11 @@ def fetch_stargazers(repo, token=None):
     headers = make_headers(token)
     headers["Accept"] = "application/vnd.github.v3.star+json"
     url = "https://api.github.com/repos/{}/stargazers".format(repo)
-    for stargazers in paginate(url, headers):
+    for stargazers in paginate(url, headers, prefetch=PAGE_PREFETCH):
         yield from stargazers
 
 
-def fetch_all_repos(username=None, token=None, org=None):
+def fetch_all_repos(username=None, token=None, org=None, conditional=False):
     assert username or token or org, "Must provide username= or token= or org= or a combination"
     headers = make_headers(token)
     # Get topics for each repo:
@@ -471,7 +1401,9 @@ def fetch_all_repos(username=None, token=None, org=None):
         url = "https://api.github.com/orgs/{}/repos".format(org)
     else:
         url = "https://api.github.com/user/repos"
-    for repos in paginate(url, headers):
+    # Not conditional by default, since callers often need every repo in order
+    # to fetch something else for it
+    for repos in paginate(url, headers, conditional=conditional):
         yield from repos
 
 
@@ -482,26 +1414,335 @@ def fetch_user(username=None, token=None):
         url = "https://api.github.com/users/{}".format(username)
     else:
         url = "https://api.github.com/user"
-    return requests.get(url, headers=headers).json()
-
-
-def paginate(url, headers=None):
-    url += ("&" if "?" in url else "?") + "per_page=100"
-    while url:
-        response = requests.get(url, headers=headers)
+    return get_session().get(url, headers=headers).json()
+
+
+def paginate(url, headers=None, conditional=True, stop_if_unchanged=False, prefetch=1):
+    """
+    Yield each page of results. With conditional=True pages that are unchanged
+    since they were last saved are skipped - or, with stop_if_unchanged=True,
+    end the pagination entirely.
+
+    With prefetch > 1, once the Link header says how many pages there are,
+    up to that many of the remaining pages are fetched at once. Pages are
+    still yielded in order.
+    """
+    url += ("&" if "?" in url else "?") + "per_page={}".format(PAGE_SIZE)
+
+    def fetch(url):
+        if conditional:
+            return conditional_get(url, headers)
+        return get_session().get(url, headers=headers), None
+
+    page_urls = []
+    while url and not page_urls:
+        response, cached = fetch(url)
+        unchanged = response.status_code == 304
+        if unchanged:
+            if stop_if_unchanged:
+                return
+            # A Link header sent with the 304 is more up to date than ours
+            next_url = next_page_url(response) or cached["next_url"]
+            if next_url or cached.get("full") == 0:
+                url = next_url
+                continue
+            # This was the last page, but it was full (or we don't know) so
+            # another page may have been added since: fetch it again in full
+            # for a current Link header
+            response = get_session().get(url, headers=headers)
+        data = page_data(response)
         # For HTTP 204 no-content this yields an empty list
-        if response.status_code == 204:
+        if data is None:
             return
-        data = response.json()
-        if isinstance(data, dict) and data.get("message"):
-            raise GitHubError.from_response(response)
-        try:
-            url = response.links.get("next").get("url")
-        except AttributeError:
-            url = None
+        page_url = url
+        url = next_page_url(response)
+        if conditional:
+            store_http_cache(
+                page_url, headers, response, next_url=url, full=page_is_full(data)
+            )
+        if not unchanged:
+            yield data
+        if prefetch > 1:
+            page_urls = remaining_page_urls(response)
+
+    responses = map_concurrently(fetch, page_urls, prefetch)
+    for page_url, (response, cached) in zip(page_urls, responses):
+        if response.status_code == 304:
+            if stop_if_unchanged:
+                return
+            continue
+        data = page_data(response)
+        if data is None:
+            return
+        if conditional:
+            store_http_cache(
+                page_url,
+                headers,
+                response,
+                next_url=next_page_url(response),
+                full=page_is_full(data),
+            )
         yield data
 
 
+def page_data(response):
+    "The JSON for a page of results, or None for an HTTP 204 with no content"
+    if response.status_code == 204:
+        return None
+    data = response.json()
+    if isinstance(data, dict) and data.get("message"):
+        raise GitHubError.from_response(response)
+    return data
+
+
+def page_is_full(data):
+    "Could another page follow this one? Pages that are not lists might"
+    return not isinstance(data, list) or len(data) >= PAGE_SIZE
+
+
+def next_page_url(response):
+    try:
+        return response.links.get("next").get("url")
+    except AttributeError:
+        return None
+
+
+def remaining_page_urls(response):
+    "URLs of every page after this one, if its Link header has a rel=last page"
+    next_url = next_page_url(response)
+    last_url = response.links.get("last", {}).get("url")
+    page_re = re.compile(r"([?&]page=)(\d+)")
+    next_match = page_re.search(next_url or "")
+    last_match = page_re.search(last_url or "")
+    if not (next_match and last_match):
+        return []
+    return [
+        page_re.sub(lambda m: m.group(1) + str(page), next_url)
+        for page in range(int(next_match.group(2)), int(last_match.group(2)) + 1)
+    ]
+
+
+def conditional_get(url, headers=None):
+    """
+    GET url, sending If-None-Match / If-Modified-Since if the HTTP cache has
+    seen it before. Returns (response, cached entry or None).
+    """
+    session = get_session()
+    cache = getattr(session, "http_cache", None)
+    cached = cache.get(url, headers) if cache is not None else None
+    if cached:
+        headers = dict(headers or {})
+        if cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached["last_modified"]:
+            headers["If-Modified-Since"] = cached["last_modified"]
+    response = session.get(url, headers=headers)
+    return response, cached
+
+
+def store_http_cache(url, headers, response, next_url=None, body=None, full=None):
+    cache = getattr(get_session(), "http_cache", None)
+    if cache is not None:
+        cache.store(url, headers, response, next_url=next_url, body=body, full=full)
+
+
+def enable_http_cache(db, repo_max_age=None):
+    "Send conditional requests using validators stored in this database"
+    disable_http_cache()
+    get_session().http_cache = HttpCache.load(db, repo_max_age)
+
+
+def disable_http_cache():
+    cache = getattr(get_session(), "http_cache", None)
+    if cache is not None:
+        cache.close()
+    get_session().http_cache = None
+
+
+def discard_http_cache(prefix):
+    "Drop unsaved validators for URLs starting with prefix, after a failed sync"
+    cache = getattr(get_session(), "http_cache", None)
+    if cache is not None:
+        cache.discard(prefix)
+
+
+def save_http_cache(db):
+    "Save validators for this run's responses - call once their data is saved"
+    cache = getattr(get_session(), "http_cache", None)
+    if cache is not None:
+        cache.save(db)
+
+
+def make_session(pool_size=10, max_retries=3, backoff_factor=0.5):
+    "Create a rate limited, keep-alive session with a connection pool and retries"
+    session = GitHubSession()
+    retry = Retry(
+        total=max_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset(["GET", "HEAD"]),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["Accept-Encoding"] = "gzip, deflate"
+    return session
+
+
+def get_session():
+    "Return the session shared by every fetch_* function, creating it if necessary"
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = make_session()
+        return _session
+
+
+def set_session(session):
+    "Use this session for all subsequent requests - pass None to reset to the default"
+    global _session
+    with _session_lock:
+        _session = session
+
+
+def use_tokens(tokens):
+    "Spread requests made with any of these tokens across all of them"
+    get_session().tokens = list(tokens)
+
+
+@contextlib.contextmanager
+def reserve_connections(count):
+    """
+    Grow the shared session's connection pools to cover count more threads
+    making requests at once. Nested map_concurrently() calls - several repos,
+    each prefetching several pages - add up, and requests beyond the pool
+    size would otherwise throw away their keep-alive connections.
+    """
+    session = get_session()
+    with _session_lock:
+        # Starts at one, for the main thread
+        session.workers = getattr(session, "workers", 1) + count
+        for adapter in set(session.adapters.values()):
+            if isinstance(adapter, HTTPAdapter) and (
+                adapter._pool_maxsize < session.workers
+            ):
+                adapter.init_poolmanager(
+                    adapter._pool_connections,
+                    session.workers,
+                    block=adapter._pool_block,
+                )
+    try:
+        yield
+    finally:
+        with _session_lock:
+            session.workers -= count
+
+
+def map_concurrently(fn, items, concurrency=1):
+    """
+    Yield fn(item) for each item, running up to concurrency calls at once in
+    worker threads. Results are yielded in the original order so the caller
+    can write them to the database from a single thread.
+    """
+    if concurrency <= 1:
+        for item in items:
+            yield fn(item)
+        return
+    with reserve_connections(concurrency), ThreadPoolExecutor(
+        max_workers=concurrency
+    ) as executor:
+        pending = collections.deque()
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= concurrency:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def fetch_for_repos(full_names, token, fetch, concurrency=1):
+    """
+    Yield (repo, items) for each "owner/name", where items is fetch(full_name).
+
+    With concurrency > 1 the following repos are fetched in worker threads
+    while the current one's items are consumed. Each worker hands its items
+    over through a queue of at most FETCH_AHEAD, so that is all that is held
+    in memory per repo. Items not consumed before moving on to the next repo
+    are discarded.
+    """
+    if concurrency <= 1:
+        for full_name in full_names:
+            yield fetch_repo(full_name, token), fetch(full_name)
+        return
+
+    def produce(full_name, items, cancelled):
+        def put(message):
+            # Give up once the consumer has moved on, rather than block
+            while not cancelled.is_set():
+                try:
+                    items.put(message, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            if not put(("repo", fetch_repo(full_name, token))):
+                return
+            for item in fetch(full_name):
+                if not put(("item", item)):
+                    return
+        except Exception as e:
+            put(("error", e))
+        else:
+            put(("done", None))
+
+    def receive(items):
+        kind, value = items.get()
+        if kind == "error":
+            raise value
+        return value
+
+    def consume(items):
+        while True:
+            kind, value = items.get()
+            if kind == "error":
+                raise value
+            if kind == "done":
+                return
+            yield value
+
+    with reserve_connections(concurrency), ThreadPoolExecutor(
+        max_workers=concurrency
+    ) as executor:
+        pending = collections.deque()
+
+        def start(full_name):
+            items = queue.Queue(maxsize=FETCH_AHEAD)
+            cancelled = threading.Event()
+            executor.submit(produce, full_name, items, cancelled)
+            pending.append((items, cancelled))
+
+        full_names = iter(full_names)
+        for full_name in itertools.islice(full_names, concurrency):
+            start(full_name)
+        try:
+            while pending:
+                items, cancelled = pending[0]
+                yield receive(items), consume(items)
+                # Free this repo's worker for the next one
+                cancelled.set()
+                pending.popleft()
+                for full_name in itertools.islice(full_names, 1):
+                    start(full_name)
+        finally:
+            for items, cancelled in pending:
+                cancelled.set()
+
+
 def make_headers(token=None):
     headers = {}
     if token is not None:
@@ -509,69 +1750,107 @@ def make_headers(token=None):
     return headers
 
 
+@buffers_users
 def save_stars(db, user, stars):
     user_id = save_user(db, user)
 
-    for star in stars:
-        starred_at = star["starred_at"]
-        repo = star["repo"]
-        repo_id = save_repo(db, repo)
-        db["stars"].insert(
-            {"user": user_id, "repo": repo_id, "starred_at": starred_at},
-            pk=("user", "repo"),
-            foreign_keys=("user", "repo"),
-            replace=True,
-        )
+    for batch in batches(stars, get_batch_size(db)):
+        with transaction(db):
+            # Starred repos are unique, but --load files might repeat them
+            repos = {}
+            rows = []
+            for star in batch:
+                repo = repo_row(db, star["repo"])
+                repos[repo["id"]] = repo
+                rows.append(
+                    {
+                        "user": user_id,
+                        "repo": repo["id"],
+                        "starred_at": star["starred_at"],
+                    }
+                )
+            flush_users(db)
+            save_repos(db, list(repos.values()))
+            db["stars"].insert_all(
+                rows,
+                pk=("user", "repo"),
+                foreign_keys=("user", "repo"),
+                replace=True,
+            )
 
 
+@buffers_users
 def save_stargazers(db, repo_id, stargazers):
-    for stargazer in stargazers:
-        starred_at = stargazer["starred_at"]
-        user_id = save_user(db, stargazer["user"])
-        db["stars"].upsert(
-            {"user": user_id, "repo": repo_id, "starred_at": starred_at},
-            pk=("user", "repo"),
-            foreign_keys=("user", "repo"),
-        )
+    for batch in batches(stargazers, get_batch_size(db)):
+        with transaction(db):
+            rows = [
+                {
+                    "user": save_user(db, stargazer["user"]),
+                    "repo": repo_id,
+                    "starred_at": stargazer["starred_at"],
+                }
+                for stargazer in batch
+            ]
+            flush_users(db)
+            db["stars"].upsert_all(
+                rows,
+                pk=("user", "repo"),
+                foreign_keys=("user", "repo"),
+            )
 
 
+@buffers_users
 def save_releases(db, releases, repo_id=None):
     foreign_keys = [("author", "users", "id")]
     if repo_id:
         foreign_keys.append(("repo", "repos", "id"))
-    for original in releases:
-        # Ignore all of the _url fields except html_url
-        release = {
-            key: value
-            for key, value in original.items()
-            if key == "html_url" or not key.endswith("url")
-        }
-        assets = release.pop("assets") or []
-        release["repo"] = repo_id
-        release["author"] = save_user(db, release["author"])
-        release_id = (
-            db["releases"]
-            .insert(
-                release, pk="id", foreign_keys=foreign_keys, alter=True, replace=True
+    for batch in batches(releases, get_batch_size(db)):
+        with transaction(db):
+            rows = []
+            # Assets for every release in the batch are written together
+            assets = []
+            for original in batch:
+                release, release_assets = release_row(db, original, repo_id)
+                rows.append(release)
+                assets.extend(release_assets)
+            flush_users(db)
+            prepare_fts_write(db, "releases")
+            db["releases"].insert_all(
+                rows,
+                pk="id",
+                foreign_keys=foreign_keys,
+                alter=True,
+                replace=True,
+            )
+            db["assets"].upsert_all(
+                assets,
+                pk="id",
+                foreign_keys=[
+                    ("uploader", "users", "id"),
+                    ("release", "releases", "id"),
+                ],
+                alter=True,
             )
-            .last_pk
-        )
-        # Handle assets
-        for asset in assets:
-            asset["uploader"] = save_user(db, asset["uploader"])
-            asset["release"] = release_id
 
-        db["assets"].upsert_all(
-            assets,
-            pk="id",
-            foreign_keys=[
-                ("uploader", "users", "id"),
-                ("release", "releases", "id"),
-            ],
-            alter=True,
-        )
+
+def release_row(db, original, repo_id):
+    "Returns (release row, asset rows) for a release from the API"
+    # Ignore all of the _url fields except html_url
+    release = {
+        key: value
+        for key, value in original.items()
+        if key == "html_url" or not key.endswith("url")
+    }
+    assets = release.pop("assets") or []
+    release["repo"] = repo_id
+    release["author"] = save_user(db, release["author"])
+    for asset in assets:
+        asset["uploader"] = save_user(db, asset["uploader"])
+        asset["release"] = release["id"]
+    return release, assets
 
 
+@buffers_users
 def save_contributors(db, contributors, repo_id):
     contributor_rows_to_add = []
     for contributor in contributors:
@@ -580,6 +1859,7 @@ def save_contributors(db, contributors, repo_id):
         contributor_rows_to_add.append(
             {"repo_id": repo_id, "user_id": user_id, "contributions": contributions}
         )
+    flush_users(db)
     db["contributors"].insert_all(
         contributor_rows_to_add,
         pk=("repo_id", "user_id"),
@@ -613,7 +1893,9 @@ def save_tags(db, tags, repo_id):
     )
 
 
+@buffers_users
 def save_commits(db, commits, repo_id=None):
+    "Save commits in batches, returning the SHAs that were saved"
     foreign_keys = [
         ("author", "users", "id"),
         ("committer", "users", "id"),
@@ -651,27 +1933,55 @@ def save_commits(db, commits, repo_id=None):
             foreign_keys=foreign_keys,
         )
 
-    for commit in commits:
-        commit_to_insert = {
-            "sha": commit["sha"],
-            "message": commit["commit"]["message"],
-            "author_date": commit["commit"]["author"]["date"],
-            "committer_date": commit["commit"]["committer"]["date"],
-            "raw_author": save_commit_author(db, commit["commit"]["author"]),
-            "raw_committer": save_commit_author(db, commit["commit"]["committer"]),
-        }
-        commit_to_insert["repo"] = repo_id
-        commit_to_insert["author"] = (
-            save_user(db, commit["author"]) if commit["author"] else None
-        )
-        commit_to_insert["committer"] = (
+    # The same few authors turn up on commit after commit, so each distinct
+    # raw author is only written once per run
+    raw_authors_seen = run_state(db).setdefault("raw_authors_seen", set())
+    saved_shas = []
+    for batch in batches(commits, get_batch_size(db)):
+        with transaction(db):
+            raw_authors = {}
+            rows = [commit_row(db, commit, repo_id, raw_authors) for commit in batch]
+            new_raw_authors = [
+                raw_author
+                for raw_author_id, raw_author in raw_authors.items()
+                if raw_author_id not in raw_authors_seen
+            ]
+            if new_raw_authors:
+                # ids are hashes of the content, so existing rows are unchanged
+                db["raw_authors"].insert_all(new_raw_authors, pk="id", ignore=True)
+                raw_authors_seen.update(raw_authors)
+            prepare_fts_write(db, "commits")
+            db["commits"].insert_all(rows, pk="sha", alter=True, replace=True)
+        saved_shas.extend(row["sha"] for row in rows)
+    return saved_shas
+
+
+def commit_row(db, commit, repo_id, raw_authors):
+    "Commit row for the commits table, collecting raw authors by id"
+    raw_author = raw_author_row(commit["commit"]["author"])
+    raw_committer = raw_author_row(commit["commit"]["committer"])
+    raw_authors[raw_author["id"]] = raw_author
+    raw_authors[raw_committer["id"]] = raw_committer
+    return {
+        "sha": commit["sha"],
+        "message": commit["commit"]["message"],
+        "author_date": commit["commit"]["author"]["date"],
+        "committer_date": commit["commit"]["committer"]["date"],
+        "raw_author": raw_author["id"],
+        "raw_committer": raw_committer["id"],
+        "repo": repo_id,
+        "author": save_user(db, commit["author"]) if commit["author"] else None,
+        "committer": (
             save_user(db, commit["committer"]) if commit["committer"] else None
-        )
-        db["commits"].insert(
-            commit_to_insert,
-            alter=True,
-            replace=True,
-        )
+        ),
+    }
+
+
+def raw_author_row(raw_author):
+    "Row for raw_authors, with the same id as insert(..., hash_id='id') gives it"
+    row = {"name": raw_author.get("name"), "email": raw_author.get("email")}
+    row["id"] = hash_record(row)
+    return row
 
 
 def save_commit_author(db, raw_author):
@@ -691,11 +2001,48 @@ def save_commit_author(db, raw_author):
     )
 
 
+def get_sync_state(db, repo, resource):
+    "The newest updated_at saved by a previous incremental sync, or None"
+    if not db["_sync_state"].exists():
+        return None
+    rows = list(
+        db["_sync_state"].rows_where(
+            "repo = ? and resource = ?", [repo, resource], select="updated_at"
+        )
+    )
+    return rows[0]["updated_at"] if rows else None
+
+
+def save_sync_state(db, repo, resource, updated_at):
+    "Record the newest updated_at we have saved - call after saving everything"
+    previous = get_sync_state(db, repo, resource)
+    if updated_at is None or (previous and previous >= updated_at):
+        return
+    db["_sync_state"].upsert(
+        {"repo": repo, "resource": resource, "updated_at": updated_at},
+        pk=("repo", "resource"),
+    )
+
+
+def track_newest(items, newest, key="updated_at"):
+    "Yield items, recording the largest item[key] seen in the newest dictionary"
+    for item in items:
+        value = item.get(key)
+        if value and (newest.get(key) is None or value > newest[key]):
+            newest[key] = value
+        yield item
+
+
 def ensure_foreign_keys(db):
     for expected_foreign_key in FOREIGN_KEYS:
         table, column, table2, column2 = expected_foreign_key
+        # sqlite-utils 4 ForeignKey objects no longer compare equal to tuples
+        existing = {
+            (fk.table, fk.column, fk.other_table, fk.other_column)
+            for fk in db[table].foreign_keys
+        }
         if (
-            expected_foreign_key not in db[table].foreign_keys
+            expected_foreign_key not in existing
             and
             # Ensure all tables and columns exist
             db[table].exists()
@@ -706,20 +2053,34 @@ def ensure_foreign_keys(db):
             db[table].add_foreign_key(column, table2, column2)
 
 
-def ensure_db_shape(db):
-    "Ensure FTS is configured and expected FKS, views and (soon) indexes are present"
+def ensure_db_shape(db, force=False):
+    "Ensure FTS is configured and expected FKS, views and indexes are present"
+    # Nothing to do if neither the schema nor our configuration has changed
+    # since the last time this ran to completion
+    if not force and schema_fingerprint(db) == get_db_shape_state(db, "fingerprint"):
+        return
+
     # Foreign keys:
     ensure_foreign_keys(db)
     db.index_foreign_keys()
 
-    # FTS:
+    # Indexes:
     existing_tables = set(db.table_names())
+    for table, columns in INDEXES:
+        if table in existing_tables:
+            db[table].create_index(columns, if_not_exists=True)
+
+    # FTS:
     for table, columns in FTS_CONFIG.items():
-        if "{}_fts".format(table) in existing_tables:
-            continue
         if table not in existing_tables:
             continue
-        db[table].enable_fts(columns, create_triggers=True)
+        if "{}_fts".format(table) not in existing_tables:
+            db[table].enable_fts(columns, create_triggers=True)
+        elif not has_fts_triggers(db, table):
+            # defer_fts() dropped the triggers because this table was written
+            # to - rebuild its whole index in one pass and put them back
+            db[table].enable_fts(columns, create_triggers=True, replace=True)
+            db[table].optimize()
 
     # Views:
     existing_views = set(db.view_names())
@@ -730,45 +2091,140 @@ def ensure_db_shape(db):
             continue
         db.create_view(view, sql, replace=True)
 
+    set_db_shape_state(db, "fingerprint", schema_fingerprint(db))
+
+
+def defer_fts(db):
+    """
+    For the rest of this run, drop the triggers that update a table's FTS
+    index row by row before the first write to it, making bulk writes
+    cheaper. The next ensure_db_shape() rebuilds the indexes of just those
+    tables and puts their triggers back.
+    """
+    run_state(db).setdefault("fts_deferred", set())
+
+
+def prepare_fts_write(db, table):
+    "Call before writing to table, so defer_fts() can drop its FTS triggers"
+    deferred = run_state(db).get("fts_deferred")
+    if deferred is None or table in deferred:
+        return
+    deferred.add(table)
+    for suffix in FTS_TRIGGER_SUFFIXES:
+        db.execute('drop trigger if exists "{}{}"'.format(table, suffix))
+
+
+def has_fts_triggers(db, table):
+    names = {trigger.name for trigger in db[table].triggers}
+    return all(table + suffix in names for suffix in FTS_TRIGGER_SUFFIXES)
+
+
+def schema_fingerprint(db):
+    "Hash of the database schema plus the FTS, view, FK and index configuration"
+    hasher = hashlib.sha256()
+    for row in db.execute(
+        "select type, name, sql from sqlite_master "
+        "where tbl_name != '_db_shape' order by type, name"
+    ):
+        hasher.update(json.dumps(row).encode("utf-8"))
+    config = [FTS_CONFIG, VIEWS, FOREIGN_KEYS, INDEXES]
+    hasher.update(json.dumps(config, default=sorted).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def get_db_shape_state(db, key):
+    if not db["_db_shape"].exists():
+        return None
+    rows = list(db["_db_shape"].rows_where("key = ?", [key], select="value"))
+    return rows[0]["value"] if rows else None
+
+
+def set_db_shape_state(db, key, value):
+    db["_db_shape"].upsert({"key": key, "value": value}, pk="key")
+
+
+def optimize(db, vacuum=False):
+    "Bring the database fully up to date then optimize FTS indexes and statistics"
+    ensure_db_shape(db, force=True)
+    for table in FTS_CONFIG:
+        if db[table].exists():
+            db[table].optimize()
+    db.analyze()
+    if vacuum:
+        db.vacuum()
+
 
 def scrape_dependents(repo, verbose=False):
     # Optional dependency:
-    from bs4 import BeautifulSoup
+    from bs4 import BeautifulSoup, SoupStrainer
 
+    # Only the links are needed, so only those are parsed
+    parse_only = SoupStrainer("a")
+    parser = html_parser()
     url = "https://github.com/{}/network/dependents".format(repo)
-    while url:
-        if verbose:
-            print(url)
-        response = requests.get(url)
-        soup = BeautifulSoup(response.content, "html.parser")
-        repos = [
-            a["href"].lstrip("/")
-            for a in soup.select("a[data-hovercard-type=repository]")
-        ]
-        if verbose:
-            print(repos)
-        yield from repos
-        # next page?
-        try:
-            next_link = soup.select(".paginate-container")[0].find("a", string="Next")
-        except IndexError:
-            break
-        if next_link is not None:
-            url = next_link["href"]
-            time.sleep(1)
-        else:
-            url = None
+    delay = SCRAPE_DELAY
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(fetch_scraped_page, url, delay, wait=False)
+        while future is not None:
+            if verbose:
+                print(url)
+            response, delay = future.result()
+            soup = BeautifulSoup(response.content, parser, parse_only=parse_only)
+            repos = [
+                a["href"].lstrip("/")
+                for a in soup.select("a[data-hovercard-type=repository]")
+            ]
+            # next page? Start fetching it while the caller handles this one
+            next_link = soup.find("a", string="Next", href=True)
+            future = None
+            if next_link is not None:
+                url = next_link["href"]
+                future = executor.submit(fetch_scraped_page, url, delay)
+            if verbose:
+                print(repos)
+            yield from repos
+
+
+def fetch_scraped_page(url, delay=SCRAPE_DELAY, wait=True):
+    """
+    Fetch a github.com HTML page, first waiting delay seconds if wait is set.
+    Returns (response, delay to use before the next page).
+    """
+    attempt = 0
+    while True:
+        if wait:
+            time.sleep(delay)
+        wait = True
+        response = get_session().get(url)
+        if response.status_code != 429:
+            return response, max(SCRAPE_MIN_DELAY, delay * 0.75)
+        if attempt >= MAX_RATE_LIMIT_RETRIES:
+            response.raise_for_status()
+        attempt += 1
+        delay = min(SCRAPE_MAX_DELAY, delay * 2)
+        retry_after = response.headers.get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, int(retry_after))
+
+
+def html_parser():
+    "lxml is much faster than html.parser, use it if it is installed"
+    try:
+        import lxml
+    except ImportError:
+        return "html.parser"
+    return "lxml"
 
 
 def fetch_emojis(token=None):
     headers = make_headers(token)
-    response = requests.get("https://api.github.com/emojis", headers=headers)
+    response = get_session().get("https://api.github.com/emojis", headers=headers)
     response.raise_for_status()
     return [{"name": key, "url": value} for key, value in response.json().items()]
 
 
 def fetch_image(url):
-    return requests.get(url).content
+    return get_session().get(url).content
 
 
 def get(url, token=None, accept=None):
@@ -777,23 +2233,41 @@ def get(url, token=None, accept=None):
         headers["accept"] = accept
     if url.startswith("/"):
         url = "https://api.github.com{}".format(url)
-    response = requests.get(url, headers=headers)
+    response = get_session().get(url, headers=headers)
     response.raise_for_status()
     return response
 
 
+def load_repo_readmes(db, columns):
+    "Map repo id to its pushed_at and the README columns listed in columns"
+    if not db["repos"].exists():
+        return {}
+    existing = db["repos"].columns_dict
+    select = ", ".join(
+        "[{}]".format(column) if column in existing else "null as [{}]".format(column)
+        for column in ["id", "pushed_at"] + list(columns)
+    )
+    cursor = db.execute("select {} from repos".format(select))
+    keys = [description[0] for description in cursor.description]
+    return {row[0]: dict(zip(keys, row)) for row in cursor}
+
+
 def fetch_readme(token, full_name, html=False):
     headers = make_headers(token)
     if html:
         headers["accept"] = "application/vnd.github.VERSION.html"
     url = "https://api.github.com/repos/{}/readme".format(full_name)
-    response = requests.get(url, headers=headers)
+    response, cached = conditional_get(url, headers)
+    if response.status_code == 304:
+        return get_session().http_cache.body(cached)
     if response.status_code != 200:
         return None
     if html:
-        return rewrite_readme_html(response.text)
+        readme = rewrite_readme_html(response.text)
     else:
-        return base64.b64decode(response.json()["content"]).decode("utf-8")
+        readme = base64.b64decode(response.json()["content"]).decode("utf-8")
+    store_http_cache(url, headers, response, body=readme)
+    return readme
 
 
 _href_re = re.compile(r'\shref="#([^"]+)"')
@@ -819,14 +2293,16 @@ def rewrite_readme_html(html):
 def fetch_workflows(token, full_name):
     headers = make_headers(token)
     url = "https://api.github.com/repos/{}/contents/.github/workflows".format(full_name)
-    response = requests.get(url, headers=headers)
-    if response.status_code == 404:
+    response, cached = conditional_get(url, headers)
+    # 304 means none of the workflow files have changed since they were saved
+    if response.status_code in (304, 404):
         return {}
     workflows = {}
     for item in response.json():
         name = item["name"]
-        content = requests.get(item["download_url"]).text
+        content = get_session().get(item["download_url"]).text
         workflows[name] = content
+    store_http_cache(url, headers, response)
     return workflows
 
 
@@ -1,5 +1,5 @@
 from click.testing import CliRunner
-from github_to_sqlite import cli
+from github_to_sqlite import cli, utils
 import json
 import os
 import pytest
@@ -44,3 +44,21 @@ def test_auth_environment_variable(mocked_starred, monkeypatch):
         assert 0 == result.exit_code
         assert mocked_starred.called
         assert "token xyz" == mocked_starred.last_request.headers["authorization"]
+
+
+def test_auth_file_token_list(mocked_starred):
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        open("auth.json", "w").write(
+            json.dumps({"github_personal_token": ["xxx", "yyy"]})
+        )
+        result = runner.invoke(
+            cli.cli, ["starred", "starred.db"], catch_exceptions=False
+        )
+        assert 0 == result.exit_code
+        assert ["xxx", "yyy"] == utils.get_session().tokens
+        assert mocked_starred.last_request.headers["authorization"] in (
+            "token xxx",
+            "token yyy",
+        )
+    utils.use_tokens([])
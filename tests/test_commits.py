@@ -1,4 +1,5 @@
-from github_to_sqlite import utils
+from click.testing import CliRunner
+from github_to_sqlite import cli, utils
 import pytest
 import pathlib
 import sqlite_utils
@@ -87,3 +88,77 @@ def test_commits(db):
             "email": "swillison@gmail.com",
         }
     ] == raw_author_rows
+
+
+def test_fetch_commits_since_and_sha(requests_mock, commits):
+    requests_mock.get(
+        "https://api.github.com/repos/simonw/datasette/commits", json=commits
+    )
+    fetched = list(
+        utils.fetch_commits(
+            "simonw/datasette", since="2019-11-11T05:31:00Z", sha="release"
+        )
+    )
+    assert 2 == len(fetched)
+    assert {
+        "sha": ["release"],
+        "since": ["2019-11-11t05:31:00z"],
+        "per_page": ["100"],
+    } == requests_mock.last_request.qs
+
+
+def test_raw_authors_written_once(commits, repo, monkeypatch):
+    db = sqlite_utils.Database(memory=True)
+    utils.configure_db(db, batch_size=1)
+    utils.save_repo(db, repo)
+    written = []
+    original_insert_all = sqlite_utils.db.Table.insert_all
+
+    def insert_all(table, records, **kwargs):
+        records = list(records)
+        if table.name == "raw_authors":
+            written.extend(records)
+        return original_insert_all(table, records, **kwargs)
+
+    monkeypatch.setattr(sqlite_utils.db.Table, "insert_all", insert_all)
+    utils.save_commits(db, commits, repo["id"])
+    utils.save_commits(db, commits, repo["id"])
+    # Both commits share an author: one row, with the id hash_id= would give it
+    assert ["Simon Willison"] == [author["name"] for author in written]
+    expected_id = (
+        sqlite_utils.Database(memory=True)["raw_authors"]
+        .insert(
+            {"name": "Simon Willison", "email": "swillison@gmail.com"}, hash_id="id"
+        )
+        .last_pk
+    )
+    assert [expected_id] == [row["id"] for row in db["raw_authors"].rows]
+    assert 2 == db["commits"].count
+
+
+@pytest.mark.parametrize("command", ["commits", "sync"])
+def test_fork_stops_at_history_saved_this_run(
+    requests_mock, tmpdir, commits, repo, command
+):
+    fork_commit = dict(commits[0], sha="f" * 40)
+    for id, name, repo_commits in (
+        (1, "simonw/one", commits),
+        (2, "simonw/two", [fork_commit] + commits),
+    ):
+        requests_mock.get(
+            "https://api.github.com/repos/{}".format(name),
+            json=dict(repo, id=id, full_name=name),
+        )
+        requests_mock.get(
+            "https://api.github.com/repos/{}/commits".format(name), json=repo_commits
+        )
+    db_path = str(tmpdir / "commits.db")
+    args = [command, db_path, "simonw/one", "simonw/two"]
+    if command == "sync":
+        args += ["-r", "commits"]
+    result = CliRunner().invoke(cli.cli, args, catch_exceptions=False)
+    assert 0 == result.exit_code
+    db = sqlite_utils.Database(db_path)
+    assert [(1, 2), (2, 1)] == db.execute(
+        "select repo, count(*) from commits group by repo order by repo"
+    ).fetchall()
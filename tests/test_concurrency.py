@@ -0,0 +1,84 @@
+from click.testing import CliRunner
+from github_to_sqlite import cli, utils
+import json
+import pathlib
+import pytest
+import sqlite_utils
+import threading
+import time
+
+REPO = json.load(open(pathlib.Path(__file__).parent / "repo.json"))
+RELEASES = json.load(open(pathlib.Path(__file__).parent / "releases.json"))
+
+
+@pytest.mark.parametrize("concurrency", [1, 3])
+def test_map_concurrently_preserves_order(concurrency):
+    threads = set()
+
+    def slow_square(n):
+        threads.add(threading.get_ident())
+        time.sleep(0.01 * (5 - n))
+        return n * n
+
+    assert [0, 1, 4, 9, 16] == list(
+        utils.map_concurrently(slow_square, range(5), concurrency)
+    )
+    if concurrency == 1:
+        assert {threading.get_ident()} == threads
+
+
+def test_releases_concurrency(requests_mock, tmpdir):
+    for id, name in ((1, "simonw/one"), (2, "simonw/two")):
+        requests_mock.get(
+            "https://api.github.com/repos/{}".format(name),
+            json=dict(REPO, id=id, full_name=name),
+        )
+        requests_mock.get(
+            "https://api.github.com/repos/{}/releases".format(name),
+            json=[dict(release, id=release["id"] + id) for release in RELEASES],
+        )
+    db_path = str(tmpdir / "releases.db")
+    result = CliRunner().invoke(
+        cli.cli,
+        ["releases", db_path, "simonw/one", "simonw/two", "--concurrency", "2"],
+        catch_exceptions=False,
+    )
+    assert 0 == result.exit_code
+    db = sqlite_utils.Database(db_path)
+    assert [(1, len(RELEASES)), (2, len(RELEASES))] == db.execute(
+        "select repo, count(*) from releases group by repo order by repo"
+    ).fetchall()
+
+
+def test_fetch_for_repos_streams_items(requests_mock, monkeypatch):
+    monkeypatch.setattr(utils, "FETCH_AHEAD", 2)
+    for name in ("simonw/one", "simonw/two", "simonw/three"):
+        requests_mock.get(
+            "https://api.github.com/repos/{}".format(name),
+            json=dict(REPO, full_name=name),
+        )
+    fetched = []
+
+    def fetch(full_name):
+        if full_name == "simonw/three":
+            raise utils.GitHubError("Not Found", 404)
+        for i in range(10):
+            fetched.append((full_name, i))
+            yield i
+
+    results = utils.fetch_for_repos(
+        ["simonw/one", "simonw/two", "simonw/three"], None, fetch, concurrency=2
+    )
+    repo, items = next(results)
+    assert "simonw/one" == repo["full_name"]
+    time.sleep(0.1)
+    # Workers only fetch a few items ahead of the consumer
+    assert len(fetched) <= 2 * (utils.FETCH_AHEAD + 1)
+    assert list(range(10)) == list(items)
+    # Items that are not consumed are skipped without blocking the next repo
+    repo, items = next(results)
+    assert "simonw/two" == repo["full_name"]
+    repo, items = next(results)
+    assert "simonw/three" == repo["full_name"]
+    with pytest.raises(utils.GitHubError):
+        list(items)
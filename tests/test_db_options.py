@@ -0,0 +1,55 @@
+from click.testing import CliRunner
+from github_to_sqlite import cli, utils
+import sqlite_utils
+
+
+def test_configure_db(tmpdir):
+    db = sqlite_utils.Database(str(tmpdir / "test.db"))
+    utils.configure_db(db, wal=True, batch_size=7, cache_size=1024, mmap_size=4096)
+    assert "wal" == db.journal_mode
+    # NORMAL
+    assert 1 == db.execute("PRAGMA synchronous").fetchone()[0]
+    assert -1024 == db.execute("PRAGMA cache_size").fetchone()[0]
+    assert 7 == utils.get_batch_size(db)
+
+
+def test_default_batch_size():
+    db = sqlite_utils.Database(memory=True)
+    assert utils.BATCH_SIZE == utils.get_batch_size(db)
+
+
+def test_global_options(requests_mock, tmpdir, monkeypatch):
+    monkeypatch.setenv("GITHUB_TOKEN", "xyz")
+    requests_mock.get("https://api.github.com/user", json={"id": 1, "login": "test"})
+    requests_mock.get("https://api.github.com/user/starred", json=[])
+    configured = []
+    original_configure_db = utils.configure_db
+
+    def configure_db(db, **kwargs):
+        configured.append(kwargs)
+        return original_configure_db(db, **kwargs)
+
+    monkeypatch.setattr(utils, "configure_db", configure_db)
+    db_path = str(tmpdir / "starred.db")
+    result = CliRunner().invoke(
+        cli.cli,
+        ["--wal", "--batch-size", "50", "--synchronous", "off", "starred", db_path],
+        catch_exceptions=False,
+    )
+    assert 0 == result.exit_code
+    assert 50 == configured[0]["batch_size"]
+    assert "OFF" == configured[0]["synchronous"]
+    assert "wal" == sqlite_utils.Database(db_path).journal_mode
+
+
+def test_transaction_rolls_back_whole_block(tmpdir):
+    db = sqlite_utils.Database(str(tmpdir / "test.db"))
+    db["items"].insert({"id": 0}, pk="id")
+    try:
+        with utils.transaction(db):
+            db["items"].insert_all([{"id": 1}], pk="id")
+            db["items"].insert_all([{"id": 2}], pk="id")
+            raise ValueError
+    except ValueError:
+        pass
+    assert [0] == [row["id"] for row in db["items"].rows]
@@ -0,0 +1,63 @@
+from click.testing import CliRunner
+from github_to_sqlite import cli
+import sqlite_utils
+
+EMOJIS = "https://api.github.com/emojis"
+THUMBS_UP = "https://github.githubassets.com/images/icons/emoji/unicode/1f44d.png?v8"
+TADA = "https://github.githubassets.com/images/icons/emoji/unicode/1f389.png?v8"
+
+
+def run(db_path):
+    result = CliRunner().invoke(
+        cli.cli, ["emojis", db_path, "--fetch"], catch_exceptions=False
+    )
+    assert 0 == result.exit_code
+
+
+def test_emojis_fetch(requests_mock, tmpdir):
+    requests_mock.get(
+        EMOJIS, json={"+1": THUMBS_UP, "thumbsup": THUMBS_UP, "tada": TADA}
+    )
+    thumbs_up = requests_mock.get(THUMBS_UP, content=b"thumbs-up")
+    tada = requests_mock.get(TADA, content=b"tada")
+    db_path = str(tmpdir / "emojis.db")
+    run(db_path)
+    db = sqlite_utils.Database(db_path)
+    assert [
+        {"name": "+1", "url": THUMBS_UP, "image": b"thumbs-up", "image_url": THUMBS_UP},
+        {"name": "tada", "url": TADA, "image": b"tada", "image_url": TADA},
+        {
+            "name": "thumbsup",
+            "url": THUMBS_UP,
+            "image": b"thumbs-up",
+            "image_url": THUMBS_UP,
+        },
+    ] == list(db["emojis"].rows_where(order_by="name"))
+    # Aliases share a single download
+    assert 1 == thumbs_up.call_count
+    # Nothing is downloaded again unless the URL changes
+    run(db_path)
+    assert (1, 1) == (thumbs_up.call_count, tada.call_count)
+    new_tada = TADA.replace("v8", "v9")
+    requests_mock.get(EMOJIS, json={"+1": THUMBS_UP, "tada": new_tada})
+    requests_mock.get(new_tada, content=b"new-tada")
+    run(db_path)
+    assert b"new-tada" == db["emojis"].get("tada")["image"]
+    assert 1 == thumbs_up.call_count
+
+
+def test_emojis_fetch_images_saved_without_url(requests_mock, tmpdir):
+    requests_mock.get(EMOJIS, json={"tada": TADA})
+    tada = requests_mock.get(TADA, content=b"tada")
+    db_path = str(tmpdir / "emojis.db")
+    db = sqlite_utils.Database(db_path)
+    # As saved by earlier versions, which did not record image_url
+    db["emojis"].insert(
+        {"name": "tada", "url": TADA.replace("v8", "v7"), "image": b"old-tada"},
+        pk="name",
+    )
+    run(db_path)
+    assert 1 == tada.call_count
+    assert (b"tada", TADA) == tuple(
+        db.execute("select image, image_url from emojis").fetchone()
+    )
@@ -0,0 +1,69 @@
+from click.testing import CliRunner
+from github_to_sqlite import cli, utils
+import json
+import pathlib
+import sqlite_utils
+
+REPO = json.load(open(pathlib.Path(__file__).parent / "repo.json"))
+RELEASES = json.load(open(pathlib.Path(__file__).parent / "releases.json"))
+
+
+def search(db, table, q):
+    return [row["id"] for row in db[table].search(q, columns=["id"])]
+
+
+def test_defer_fts_rebuilds_index():
+    db = sqlite_utils.Database(memory=True)
+    utils.save_repo(db, REPO)
+    utils.ensure_db_shape(db)
+    assert utils.has_fts_triggers(db, "repos")
+    utils.defer_fts(db)
+    # Triggers are only dropped from tables as they are written to
+    assert utils.has_fts_triggers(db, "repos")
+    utils.save_repo(db, dict(REPO, id=2, name="deferred-repo"))
+    assert not utils.has_fts_triggers(db, "repos")
+    assert utils.has_fts_triggers(db, "users")
+    assert utils.has_fts_triggers(db, "licenses")
+    assert [] == search(db, "repos", "deferred")
+    utils.ensure_db_shape(db)
+    assert utils.has_fts_triggers(db, "repos")
+    assert [2] == search(db, "repos", "deferred")
+    # Triggers are back in place for the next write
+    utils.save_repo(db, dict(REPO, id=3, name="another-deferred-repo"))
+    assert [2, 3] == sorted(search(db, "repos", "deferred"))
+
+
+def test_defer_fts_option(requests_mock, tmpdir, monkeypatch):
+    rebuilt = []
+    enable_fts = sqlite_utils.db.Table.enable_fts
+
+    def record_rebuild(table, *args, **kwargs):
+        if kwargs.get("replace"):
+            rebuilt.append(table.name)
+        return enable_fts(table, *args, **kwargs)
+
+    monkeypatch.setattr(sqlite_utils.db.Table, "enable_fts", record_rebuild)
+    requests_mock.get(
+        "https://api.github.com/repos/simonw/datasette",
+        json=dict(REPO, full_name="simonw/datasette"),
+    )
+    requests_mock.get(
+        "https://api.github.com/repos/simonw/datasette/releases", json=RELEASES
+    )
+    db_path = str(tmpdir / "releases.db")
+    commits = sqlite_utils.Database(db_path)["commits"]
+    commits.insert({"sha": "abc", "message": "Not written"}, pk="sha")
+    commits.enable_fts(["message"], create_triggers=True)
+    for options in ([], ["--defer-fts"]):
+        result = CliRunner().invoke(
+            cli.cli,
+            options + ["releases", db_path, "simonw/datasette"],
+            catch_exceptions=False,
+        )
+        assert 0 == result.exit_code
+    db = sqlite_utils.Database(db_path)
+    assert utils.has_fts_triggers(db, "releases")
+    # Only the tables written to by the second run were rebuilt
+    assert ["licenses", "releases", "repos", "users"] == rebuilt
+    assert utils.has_fts_triggers(db, "commits")
+    assert len(RELEASES) == db["releases_fts"].count
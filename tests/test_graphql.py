@@ -0,0 +1,225 @@
+from click.testing import CliRunner
+from github_to_sqlite import cli, utils
+import json
+import pathlib
+import pytest
+import sqlite_utils
+
+REPO = json.load(open(pathlib.Path(__file__).parent / "repo.json"))
+GRAPHQL = "https://api.github.com/graphql"
+LABEL = {
+    "id": 754269786,
+    "node_id": "MDU6TGFiZWw3NTQyNjk3ODY=",
+    "url": "https://api.github.com/repos/simonw/datasette/labels/plugins",
+    "name": "plugins",
+    "color": "f759cf",
+    "default": False,
+    "description": None,
+}
+AUTHOR = {
+    "login": "simonw",
+    "url": "https://github.com/simonw",
+    "avatarUrl": "https://avatars.githubusercontent.com/u/9599?v=4",
+    "__typename": "User",
+    "id": "MDQ6VXNlcjk1OTk=",
+    "databaseId": 9599,
+}
+
+
+def comment_node(id):
+    return {
+        "id": "comment-{}".format(id),
+        "databaseId": id,
+        "url": "https://github.com/simonw/datasette/issues/1#issuecomment-{}".format(
+            id
+        ),
+        "body": "Comment {}".format(id),
+        "createdAt": "2020-01-01T00:00:00Z",
+        "updatedAt": "2020-01-01T00:00:00Z",
+        "authorAssociation": "OWNER",
+        "author": AUTHOR,
+        "reactionGroups": [
+            {"content": "THUMBS_UP", "reactors": {"totalCount": 2}},
+            {"content": "HEART", "reactors": {"totalCount": 1}},
+        ],
+    }
+
+
+ISSUE_NODE = {
+    "id": "issue-1",
+    "databaseId": 101,
+    "number": 1,
+    "title": "First issue",
+    "body": "Body",
+    "state": "OPEN",
+    "locked": False,
+    "url": "https://github.com/simonw/datasette/issues/1",
+    "createdAt": "2020-01-01T00:00:00Z",
+    "updatedAt": "2020-01-02T00:00:00Z",
+    "closedAt": None,
+    "authorAssociation": "OWNER",
+    "author": AUTHOR,
+    "assignees": {"nodes": [AUTHOR]},
+    "labels": {"nodes": [{"name": "plugins"}, {"name": "deleted-label"}]},
+    "milestone": None,
+    "comments": {
+        "totalCount": 2,
+        "pageInfo": {"hasNextPage": True, "endCursor": "c1"},
+        "nodes": [comment_node(1)],
+    },
+}
+
+
+@pytest.fixture
+def mock_api(requests_mock):
+    requests_mock.get(
+        "https://api.github.com/repos/simonw/datasette",
+        json=dict(REPO, full_name="simonw/datasette"),
+    )
+    requests_mock.get(
+        "https://api.github.com/repos/simonw/datasette/labels", json=[LABEL]
+    )
+    requests_mock.get(
+        "https://api.github.com/repos/simonw/datasette/milestones", json=[]
+    )
+
+    def graphql_callback(request, context):
+        body = request.json()
+        if "node(id: $id)" in body["query"]:
+            assert {"id": "issue-1", "after": "c1"} == body["variables"]
+            return {
+                "data": {
+                    "node": {
+                        "comments": {
+                            "pageInfo": {"hasNextPage": False, "endCursor": "c2"},
+                            "nodes": [comment_node(2)],
+                        }
+                    }
+                }
+            }
+        if body["variables"]["first"] > 10:
+            context.status_code = 502
+            return {"message": "We couldn't respond to your request in time."}
+        return {
+            "data": {
+                "repository": {
+                    "issues": {
+                        "pageInfo": {"hasNextPage": False, "endCursor": "i1"},
+                        "nodes": [ISSUE_NODE],
+                    }
+                }
+            }
+        }
+
+    return requests_mock.post(GRAPHQL, json=graphql_callback)
+
+
+def test_graphql_issues_page_size():
+    assert 62 == utils.graphql_issues_page_size(comments=50, budget=10000)
+    assert 1 == utils.graphql_issues_page_size(comments=100, budget=10)
+    assert 100 == utils.graphql_issues_page_size(comments=0, budget=1000000)
+
+
+def test_fetch_issues_graphql(mock_api):
+    [(issue, comments)] = list(
+        utils.fetch_issues_graphql("simonw/datasette", "xyz", since="2020-01-01")
+    )
+    assert [LABEL] == issue["labels"]
+    assert "open" == issue["state"]
+    assert 9599 == issue["assignee"]["id"]
+    assert [1, 2] == [comment["id"] for comment in comments]
+    assert {"total_count": 3, "+1": 2, "heart": 1} == comments[0]["reactions"]
+    # Timed out queries were retried with smaller pages
+    page_sizes = [
+        request.json()["variables"]["first"]
+        for request in mock_api.request_history
+        if "repository(" in request.json()["query"]
+    ]
+    assert [62, 31, 15, 7] == page_sizes
+    assert "2020-01-01" == mock_api.request_history[0].json()["variables"]["since"]
+
+
+def test_issues_graphql_command(mock_api, tmpdir, monkeypatch):
+    monkeypatch.setenv("GITHUB_TOKEN", "xyz")
+    db_path = str(tmpdir / "issues.db")
+    result = CliRunner().invoke(
+        cli.cli,
+        ["issues", db_path, "simonw/datasette", "--graphql"],
+        catch_exceptions=False,
+    )
+    assert 0 == result.exit_code, result.output
+    db = sqlite_utils.Database(db_path)
+    assert [(101, 1, "First issue", "open", "issue", 9599, 9599)] == db.execute(
+        "select id, number, title, state, type, user, assignee from issues"
+    ).fetchall()
+    assert [(754269786, 101)] == db.execute(
+        "select labels_id, issues_id from issues_labels"
+    ).fetchall()
+    assert [(1, 101), (2, 101)] == db.execute(
+        "select id, issue from issue_comments order by id"
+    ).fetchall()
+    assert "simonw" == db["users"].get(9599)["login"]
+
+
+def test_issues_graphql_requires_token(mock_api, tmpdir, monkeypatch):
+    monkeypatch.delenv("GITHUB_TOKEN", raising=False)
+    result = CliRunner().invoke(
+        cli.cli,
+        ["issues", str(tmpdir / "issues.db"), "simonw/datasette", "--graphql"],
+    )
+    assert 1 == result.exit_code
+    assert "--graphql requires a GitHub token" in result.output
+
+
+def test_graphql_assignees_select_user_fields():
+    # Issue.assignees is a UserConnection: fragments on other Actor types
+    # would fail GitHub's query validation
+    query = utils.GRAPHQL_ISSUES_QUERY
+    assignees = query[query.index("assignees(") : query.index("labels(")]
+    assert "... on" not in assignees
+    assert "databaseId" in assignees
+
+
+def test_issues_graphql_keeps_labels_and_milestone_on_rerun(
+    mock_api, requests_mock, tmpdir, monkeypatch
+):
+    monkeypatch.setenv("GITHUB_TOKEN", "xyz")
+    monkeypatch.setitem(ISSUE_NODE, "milestone", {"number": 5})
+    milestone = {
+        "id": 555,
+        "number": 5,
+        "title": "v1",
+        "creator": {"login": "simonw", "id": 9599, "type": "User"},
+    }
+
+    def etag_callback(json):
+        def callback(request, context):
+            context.headers["ETag"] = '"v1"'
+            if request.headers.get("If-None-Match") == '"v1"':
+                context.status_code = 304
+                return None
+            return json
+
+        return callback
+
+    requests_mock.get(
+        "https://api.github.com/repos/simonw/datasette/labels",
+        json=etag_callback([LABEL]),
+    )
+    requests_mock.get(
+        "https://api.github.com/repos/simonw/datasette/milestones",
+        json=etag_callback([milestone]),
+    )
+    db_path = str(tmpdir / "issues.db")
+    for _ in range(2):
+        result = CliRunner().invoke(
+            cli.cli,
+            ["issues", db_path, "simonw/datasette", "--graphql"],
+            catch_exceptions=False,
+        )
+        assert 0 == result.exit_code, result.output
+        db = sqlite_utils.Database(db_path)
+        assert [(101, 555)] == db.execute("select id, milestone from issues").fetchall()
+        assert [(754269786, 101)] == db.execute(
+            "select labels_id, issues_id from issues_labels"
+        ).fetchall()
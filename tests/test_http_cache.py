@@ -0,0 +1,213 @@
+from click.testing import CliRunner
+from github_to_sqlite import cli, utils
+import json
+import pathlib
+import pytest
+import sqlite_utils
+
+REPO = json.load(open(pathlib.Path(__file__).parent / "repo.json"))
+RELEASES = json.load(open(pathlib.Path(__file__).parent / "releases.json"))
+
+STARGAZERS = "https://api.github.com/repos/simonw/datasette/stargazers"
+PAGE_1 = STARGAZERS + "?per_page=100"
+PAGE_2 = PAGE_1 + "&page=2"
+
+
+@pytest.fixture
+def db():
+    db = sqlite_utils.Database(memory=True)
+    utils.enable_http_cache(db)
+    yield db
+    utils.disable_http_cache()
+
+
+def test_unchanged_pages_are_skipped(requests_mock, db):
+    requests_mock.get(
+        PAGE_1,
+        [
+            {
+                "json": [{"id": 1}],
+                "headers": {
+                    "ETag": '"page-1"',
+                    "Link": '<{}>; rel="next"'.format(PAGE_2),
+                },
+            },
+            {"status_code": 304},
+        ],
+    )
+    requests_mock.get(PAGE_2, [{"json": [{"id": 2}]}, {"json": [{"id": 3}]}])
+    assert [[{"id": 1}], [{"id": 2}]] == list(utils.paginate(STARGAZERS))
+    utils.save_http_cache(db)
+    rows = list(db["_http_cache"].rows)
+    assert isinstance(rows[0].pop("fetched_at"), float)
+    assert [
+        {
+            "url": PAGE_1,
+            "accept": "",
+            "etag": '"page-1"',
+            "last_modified": None,
+            "next_url": PAGE_2,
+            "full": 0,
+            "body": None,
+        }
+    ] == rows
+    # Second time around page 1 is a 304 but we still follow it to page 2
+    assert [[{"id": 3}]] == list(utils.paginate(STARGAZERS))
+    assert '"page-1"' == requests_mock.request_history[2].headers["If-None-Match"]
+
+
+def test_full_last_page_is_fetched_again(requests_mock, db):
+    full_page = [{"id": i} for i in range(utils.PAGE_SIZE)]
+    requests_mock.get(
+        PAGE_1,
+        [
+            {"json": full_page, "headers": {"ETag": '"page-1"'}},
+            # The full page is unchanged but a page has been added after it
+            {"status_code": 304},
+            {
+                "json": full_page,
+                "headers": {
+                    "ETag": '"page-1"',
+                    "Link": '<{}>; rel="next"'.format(PAGE_2),
+                },
+            },
+        ],
+    )
+    requests_mock.get(PAGE_2, json=[{"id": 2}])
+    assert [full_page] == list(utils.paginate(STARGAZERS))
+    utils.save_http_cache(db)
+    assert [[{"id": 2}]] == list(utils.paginate(STARGAZERS))
+    assert "If-None-Match" not in requests_mock.request_history[2].headers
+
+
+def test_link_header_on_304_is_used(requests_mock, db):
+    requests_mock.get(
+        PAGE_1,
+        [
+            {"json": [{"id": 1}], "headers": {"ETag": '"page-1"'}},
+            {
+                "status_code": 304,
+                "headers": {"Link": '<{}>; rel="next"'.format(PAGE_2)},
+            },
+        ],
+    )
+    requests_mock.get(PAGE_2, json=[{"id": 2}])
+    assert [[{"id": 1}]] == list(utils.paginate(STARGAZERS))
+    utils.save_http_cache(db)
+    assert [[{"id": 2}]] == list(utils.paginate(STARGAZERS))
+
+
+def test_validators_not_sent_until_saved(requests_mock, db):
+    requests_mock.get(
+        "https://api.github.com/repos/simonw/datasette",
+        json=REPO,
+        headers={"Last-Modified": "Tue, 05 May 2020 10:00:00 GMT"},
+    )
+    utils.fetch_repo("simonw/datasette")
+    assert not db["_http_cache"].exists()
+    # Another run against the same database would not send validators yet
+    assert (
+        utils.HttpCache.load(db).get("https://api.github.com/repos/simonw/datasette")
+        is None
+    )
+
+
+def test_fetch_repo_uses_cached_body(requests_mock, db):
+    requests_mock.get(
+        "https://api.github.com/repos/simonw/datasette",
+        [{"json": REPO, "headers": {"ETag": '"repo"'}}, {"status_code": 304}],
+    )
+    assert REPO == utils.fetch_repo("simonw/datasette")
+    assert REPO == utils.fetch_repo("simonw/datasette")
+    assert '"repo"' == requests_mock.last_request.headers["If-None-Match"]
+
+
+def test_cache_keyed_on_accept_header(requests_mock, db):
+    requests_mock.get(
+        "https://api.github.com/repos/simonw/datasette/readme",
+        [
+            {"json": {"content": "SGVsbG8="}, "headers": {"ETag": '"raw"'}},
+            {"text": "<p>Hello</p>", "headers": {"ETag": '"html"'}},
+        ],
+    )
+    assert "Hello" == utils.fetch_readme(None, "simonw/datasette")
+    assert "<p>Hello</p>" == utils.fetch_readme(None, "simonw/datasette", html=True)
+    assert "If-None-Match" not in requests_mock.last_request.headers
+
+
+def test_releases_command_skips_unchanged(requests_mock, tmpdir):
+    requests_mock.get(
+        "https://api.github.com/repos/simonw/datasette",
+        json=dict(REPO, full_name="simonw/datasette"),
+    )
+    releases = requests_mock.get(
+        "https://api.github.com/repos/simonw/datasette/releases?per_page=100",
+        [{"json": RELEASES, "headers": {"ETag": '"releases"'}}, {"status_code": 304}],
+    )
+    db_path = str(tmpdir / "releases.db")
+    for i in range(2):
+        result = CliRunner().invoke(
+            cli.cli, ["releases", db_path, "simonw/datasette"], catch_exceptions=False
+        )
+        assert 0 == result.exit_code
+    assert 2 == releases.call_count
+    assert '"releases"' == releases.last_request.headers["If-None-Match"]
+    assert len(RELEASES) == sqlite_utils.Database(db_path)["releases"].count
+    # --no-http-cache sends a plain request
+    CliRunner().invoke(
+        cli.cli, ["--no-http-cache", "releases", db_path, "simonw/datasette"]
+    )
+    assert "If-None-Match" not in releases.last_request.headers
+
+
+def test_fetch_repo_reuses_fresh_copy(requests_mock, db):
+    repo = requests_mock.get(
+        "https://api.github.com/repos/simonw/datasette",
+        json=REPO,
+        headers={"ETag": '"repo"'},
+    )
+    utils.get_session().http_cache.repo_max_age = 60
+    assert REPO == utils.fetch_repo("simonw/datasette")
+    utils.save_http_cache(db)
+    # A new run against the same database uses the saved copy
+    utils.enable_http_cache(db, repo_max_age=60)
+    assert REPO == utils.fetch_repo("simonw/datasette")
+    assert 1 == repo.call_count
+    # Unless it is too old, or max_age=0 asks for a fresh copy
+    assert REPO == utils.fetch_repo("simonw/datasette", max_age=0)
+    assert 2 == repo.call_count
+    db["_http_cache"].update(
+        (repo.last_request.url, "application/vnd.github.mercy-preview+json"),
+        {"fetched_at": 0},
+    )
+    utils.enable_http_cache(db, repo_max_age=60)
+    assert REPO == utils.fetch_repo("simonw/datasette")
+    assert 3 == repo.call_count
+
+
+def test_discard_http_cache(requests_mock, db):
+    requests_mock.get(PAGE_1, json=[{"id": 1}], headers={"ETag": '"page-1"'})
+    list(utils.paginate(STARGAZERS))
+    utils.discard_http_cache("https://api.github.com/repos/simonw/")
+    utils.save_http_cache(db)
+    assert not db["_http_cache"].exists()
+
+
+def test_bodies_are_read_when_needed(requests_mock, tmpdir):
+    requests_mock.get(
+        "https://api.github.com/repos/simonw/datasette",
+        [{"json": REPO, "headers": {"ETag": '"repo"'}}, {"status_code": 304}],
+    )
+    db = sqlite_utils.Database(str(tmpdir / "cache.db"))
+    utils.enable_http_cache(db)
+    assert REPO == utils.fetch_repo("simonw/datasette")
+    utils.save_http_cache(db)
+    utils.enable_http_cache(db)
+    [entry] = utils.get_session().http_cache.entries.values()
+    assert "body" not in entry
+    # The body is read back for the 304, from a worker thread
+    [repo] = utils.map_concurrently(
+        lambda full_name: utils.fetch_repo(full_name), ["simonw/datasette"], 2
+    )
+    utils.disable_http_cache()
+    assert REPO == repo
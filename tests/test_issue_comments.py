@@ -6,8 +6,8 @@ from sqlite_utils.db import ForeignKey, Index
 import json
 
 
-@pytest.fixture
-def db():
+@pytest.fixture(params=["one-at-a-time", "batched"])
+def db(request):
     db = sqlite_utils.Database(memory=True)
     db["repos"].insert(
         {"id": 1, "full_name": "dogsheep/github-to-sqlite"},
@@ -29,8 +29,11 @@ def db():
     issue_comments = json.load(
         open(pathlib.Path(__file__).parent / "issue-comments.json")
     )
-    for comment in issue_comments:
-        utils.save_issue_comment(db, comment)
+    if request.param == "batched":
+        utils.save_issue_comments(db, issue_comments)
+    else:
+        for comment in issue_comments:
+            utils.save_issue_comment(db, comment)
     utils.ensure_db_shape(db)
     return db
 
@@ -132,3 +135,12 @@ def test_indexes(db):
             columns=["issue"],
         ),
     ] == db["issue_comments"].indexes
+
+
+def test_load_issue_ids(db):
+    assert {("dogsheep/github-to-sqlite", 3): 103} == utils.load_issue_ids(db)
+    assert {} == utils.load_issue_ids(sqlite_utils.Database(memory=True))
+    assert {("dogsheep/github-to-sqlite", 3): 103} == utils.load_issue_ids(
+        db, "Dogsheep/GitHub-to-SQLite"
+    )
+    assert {} == utils.load_issue_ids(db, "simonw/datasette")
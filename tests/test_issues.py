@@ -150,3 +150,30 @@ def test_foreign_keys(db):
             table="issues", column="user", other_table="users", other_column="id"
         ),
     ] == db["issues"].foreign_keys
+
+
+def test_labels_saved_across_batches(issues, monkeypatch):
+    monkeypatch.setattr(utils, "BATCH_SIZE", 1)
+    label = {
+        "id": 5,
+        "node_id": "MDU6TGFiZWw1",
+        "url": "https://api.github.com/repos/simonw/datasette/labels/bug",
+        "name": "bug",
+        "color": "d73a4a",
+        "default": True,
+        "description": "Something isn't working",
+    }
+    second = dict(issues[0], id=2, number=2, labels=[label])
+    first = dict(issues[0], labels=[label])
+    db = sqlite_utils.Database(memory=True)
+    db["repos"].insert({"id": 1}, pk="id")
+    utils.save_issues(db, [first, second], {"id": 1})
+    assert [label["id"]] == [r["id"] for r in db["labels"].rows]
+    assert [
+        {"labels_id": 5, "issues_id": issues[0]["id"]},
+        {"labels_id": 5, "issues_id": 2},
+    ] == list(db["issues_labels"].rows)
+    assert {
+        ForeignKey("issues_labels", "issues_id", "issues", "id"),
+        ForeignKey("issues_labels", "labels_id", "labels", "id"),
+    } == set(db["issues_labels"].foreign_keys)
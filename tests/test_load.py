@@ -0,0 +1,44 @@
+from click.testing import CliRunner
+from github_to_sqlite import cli, utils
+import io
+import json
+import pathlib
+import pytest
+import sqlite_utils
+
+REPO = json.load(open(pathlib.Path(__file__).parent / "repo.json"))
+ISSUES = json.load(open(pathlib.Path(__file__).parent / "issues.json"))
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64 * 1024])
+@pytest.mark.parametrize(
+    "dump",
+    [
+        lambda items: json.dumps(items),
+        lambda items: json.dumps(items, indent=4),
+        lambda items: "\n".join(json.dumps(item) for item in items) + "\n",
+    ],
+)
+def test_iter_json_items(dump, chunk_size):
+    items = [{"id": 1, "title": "[one], {two}"}, {"id": 2, "labels": [1, 2]}, 3]
+    fp = io.StringIO(dump(items))
+    assert items == list(utils.iter_json_items(fp, chunk_size=chunk_size))
+
+
+def test_iter_json_items_truncated():
+    with pytest.raises(json.JSONDecodeError):
+        list(utils.iter_json_items(io.StringIO('[{"id": 1}, {"id": '), chunk_size=4))
+
+
+def test_issues_load_ndjson_from_stdin(requests_mock, tmpdir):
+    requests_mock.get("https://api.github.com/repos/simonw/datasette", json=REPO)
+    db_path = str(tmpdir / "issues.db")
+    result = CliRunner().invoke(
+        cli.cli,
+        ["--batch-size", "1", "issues", db_path, "simonw/datasette", "--load", "-"],
+        input="\n".join(json.dumps(issue) for issue in ISSUES),
+        catch_exceptions=False,
+    )
+    assert 0 == result.exit_code
+    db = sqlite_utils.Database(db_path)
+    assert {issue["id"] for issue in ISSUES} == {row["id"] for row in db["issues"].rows}
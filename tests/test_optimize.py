@@ -0,0 +1,52 @@
+from click.testing import CliRunner
+from github_to_sqlite import cli, utils
+import json
+import pathlib
+import pytest
+import sqlite_utils
+
+REPO = json.load(open(pathlib.Path(__file__).parent / "repo.json"))
+
+
+@pytest.fixture
+def db():
+    db = sqlite_utils.Database(memory=True)
+    utils.save_repo(db, REPO)
+    return db
+
+
+def test_ensure_db_shape_skipped_when_unchanged(db, monkeypatch):
+    utils.ensure_db_shape(db)
+    assert "repos_fts" in db.table_names()
+    fingerprint = utils.schema_fingerprint(db)
+    assert fingerprint == utils.get_db_shape_state(db, "fingerprint")
+    calls = []
+    monkeypatch.setattr(utils, "ensure_foreign_keys", calls.append)
+    utils.ensure_db_shape(db)
+    assert [] == calls
+    # A schema change means the checks run again
+    db["releases"].insert({"id": 1, "name": "0.1", "body": "First"}, pk="id")
+    utils.ensure_db_shape(db)
+    assert [db] == calls
+    assert "releases_fts" in db.table_names()
+    utils.ensure_db_shape(db, force=True)
+    assert [db, db] == calls
+
+
+def test_fingerprint_includes_configuration(db, monkeypatch):
+    before = utils.schema_fingerprint(db)
+    monkeypatch.setitem(utils.FTS_CONFIG, "repos", ["name"])
+    assert before != utils.schema_fingerprint(db)
+
+
+def test_optimize_command(tmpdir):
+    db_path = str(tmpdir / "github.db")
+    db = sqlite_utils.Database(db_path)
+    utils.save_repo(db, REPO)
+    db.conn.close()
+    result = CliRunner().invoke(
+        cli.cli, ["optimize", db_path, "--vacuum"], catch_exceptions=False
+    )
+    assert 0 == result.exit_code
+    db = sqlite_utils.Database(db_path)
+    assert {"repos_fts", "sqlite_stat1", "_db_shape"}.issubset(db.table_names())
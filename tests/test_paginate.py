@@ -0,0 +1,58 @@
+from github_to_sqlite import utils
+import time
+
+STARGAZERS = "https://api.github.com/repos/simonw/datasette/stargazers"
+
+
+def page_url(page):
+    return STARGAZERS + "?per_page=100&page={}".format(page)
+
+
+def mock_pages(requests_mock, count):
+    def page(number):
+        def json_callback(request, context):
+            # Later pages respond first, to check they are still yielded in order
+            time.sleep(0.01 * (count - number))
+            return [{"page": number}]
+
+        return json_callback
+
+    links = {}
+    for number in range(1, count + 1):
+        links[number] = ", ".join(
+            '<{}>; rel="{}"'.format(page_url(n), rel)
+            for n, rel in ((number + 1, "next"), (count, "last"))
+            if number < count
+        )
+    requests_mock.get(
+        STARGAZERS + "?per_page=100",
+        json=page(1),
+        headers={"Link": links[1]},
+    )
+    for number in range(2, count + 1):
+        requests_mock.get(
+            page_url(number), json=page(number), headers={"Link": links[number]}
+        )
+
+
+def test_remaining_page_urls(requests_mock):
+    mock_pages(requests_mock, 4)
+    response = utils.get_session().get(STARGAZERS + "?per_page=100")
+    assert [page_url(2), page_url(3), page_url(4)] == utils.remaining_page_urls(
+        response
+    )
+    # No rel="last" on the final page
+    assert [] == utils.remaining_page_urls(utils.get_session().get(page_url(4)))
+
+
+def test_paginate_prefetch_yields_in_order(requests_mock):
+    mock_pages(requests_mock, 6)
+    pages = list(utils.paginate(STARGAZERS, prefetch=3))
+    assert [[{"page": n}] for n in range(1, 7)] == pages
+    assert 6 == requests_mock.call_count
+
+
+def test_paginate_without_prefetch_follows_next(requests_mock):
+    mock_pages(requests_mock, 3)
+    pages = list(utils.paginate(STARGAZERS))
+    assert [[{"page": n}] for n in range(1, 4)] == pages
@@ -0,0 +1,145 @@
+from github_to_sqlite import utils
+import pytest
+import time
+
+KEY = ("token xxx", "core")
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+
+    def fake_sleep(seconds):
+        sleeps.append(seconds)
+
+    monkeypatch.setattr(time, "sleep", fake_sleep)
+    return sleeps
+
+
+@pytest.fixture
+def session():
+    session = utils.GitHubSession()
+    utils.set_session(session)
+    yield session
+    utils.set_session(None)
+
+
+class FakeResponse:
+    def __init__(self, remaining, reset):
+        self.headers = {
+            "X-RateLimit-Remaining": str(remaining),
+            "X-RateLimit-Reset": str(reset),
+        }
+
+
+def test_no_delay_with_plenty_remaining(sleeps):
+    limiter = utils.RateLimiter()
+    limiter.update(KEY, FakeResponse(4000, int(time.time()) + 3600))
+    for i in range(10):
+        limiter.acquire(KEY)
+    assert [] == sleeps
+    assert 3990 == limiter.limits[KEY]["remaining"]
+
+
+def test_sleeps_until_reset_when_exhausted(sleeps, monkeypatch):
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now)
+    limiter = utils.RateLimiter()
+    limiter.update(KEY, FakeResponse(0, int(now) + 30))
+
+    def fake_sleep(seconds):
+        sleeps.append(seconds)
+        monkeypatch.setattr(time, "time", lambda: now + seconds)
+
+    monkeypatch.setattr(time, "sleep", fake_sleep)
+    limiter.acquire(KEY)
+    assert 1 == len(sleeps)
+    assert 29 < sleeps[0] <= 31
+
+
+def test_paces_requests_below_low_water(sleeps, monkeypatch):
+    now = 1000000.0
+    monkeypatch.setattr(time, "time", lambda: now)
+    limiter = utils.RateLimiter(low_water=50)
+    limiter.update(KEY, FakeResponse(11, int(now) + 100))
+    limiter.acquire(KEY)
+    assert [] == sleeps
+    # 10 requests left to spread over 100 seconds
+
+    def fake_sleep(seconds):
+        sleeps.append(seconds)
+        monkeypatch.setattr(time, "time", lambda: now + seconds)
+
+    monkeypatch.setattr(time, "sleep", fake_sleep)
+    limiter.acquire(KEY)
+    assert [10.0] == sleeps
+
+
+def test_limits_tracked_per_token_and_resource(session):
+    assert ("token xxx", "core") == session.rate_limit_key(
+        "https://api.github.com/repos/simonw/datasette",
+        {"Authorization": "token xxx"},
+    )
+    assert (None, "search") == session.rate_limit_key(
+        "https://api.github.com/search/issues?q=foo"
+    )
+    assert None == session.rate_limit_key("https://github.com/simonw/datasette")
+
+
+def test_retries_secondary_rate_limit(requests_mock, sleeps, session):
+    requests_mock.get(
+        "https://api.github.com/repos/simonw/datasette",
+        [
+            {
+                "status_code": 403,
+                "json": {"message": "You have exceeded a secondary rate limit"},
+            },
+            {
+                "status_code": 429,
+                "json": {"message": "Too many requests"},
+                "headers": {"Retry-After": "5"},
+            },
+            {"json": {"id": 1}},
+        ],
+    )
+    assert {"id": 1} == utils.fetch_repo("simonw/datasette")
+    assert [60, 5] == sleeps
+
+
+def test_gives_up_after_max_retries(requests_mock, sleeps, session, monkeypatch):
+    monkeypatch.setattr(utils, "MAX_RATE_LIMIT_RETRIES", 2)
+    requests_mock.get(
+        "https://api.github.com/repos/simonw/datasette/issues?state=all&filter=all&per_page=100",
+        status_code=403,
+        json={"message": "You have exceeded a secondary rate limit"},
+    )
+    with pytest.raises(utils.GitHubError):
+        list(utils.fetch_issues("simonw/datasette"))
+    assert [60, 120] == sleeps
+
+
+def test_token_pool_routes_to_most_headroom(requests_mock, session, sleeps):
+    remaining = {"token one": 100, "token two": 3000, "token other": 10}
+    reset = str(int(time.time()) + 3600)
+
+    def callback(request, context):
+        auth = request.headers["Authorization"]
+        remaining[auth] -= 1
+        context.headers = {
+            "X-RateLimit-Remaining": str(remaining[auth]),
+            "X-RateLimit-Reset": reset,
+        }
+        return {}
+
+    requests_mock.get("https://api.github.com/user", json=callback)
+    utils.use_tokens(["one", "two"])
+    for i in range(4):
+        session.get("https://api.github.com/user", headers=utils.make_headers("one"))
+    used = [
+        request.headers["Authorization"] for request in requests_mock.request_history
+    ]
+    # Each token is tried once, after which the one with more left wins
+    assert ["token one", "token two", "token two", "token two"] == used
+    # Requests with a token outside the pool are left alone
+    session.get("https://api.github.com/user", headers=utils.make_headers("other"))
+    assert "token other" == requests_mock.last_request.headers["Authorization"]
@@ -197,3 +197,22 @@ def test_recent_releases_view(db):
             "topics": "[]",
         },
     ] == rows
+
+
+def test_fetch_releases_stops_at_known_release(db, releases, requests_mock):
+    new_release = dict(releases[0], id=1, assets=[])
+    edited = dict(releases[0], body="Edited")
+    requests_mock.get(
+        "https://api.github.com/repos/dogsheep/github-to-sqlite/releases",
+        json=[new_release, edited] + releases[1:],
+    )
+    stop_when = utils.stop_at_known_releases(db, ["Dogsheep/github-to-sqlite"])
+    fetched = list(
+        utils.fetch_releases("dogsheep/github-to-sqlite", stop_when=stop_when)
+    )
+    # The edited release is fetched again, the unchanged one after it is not
+    assert [1, releases[0]["id"]] == [release["id"] for release in fetched]
+    # Only releases of the requested repos are loaded
+    assert utils.stop_at_known_releases(db, ["simonw/datasette"]) is None
+    empty = sqlite_utils.Database(memory=True)
+    assert utils.stop_at_known_releases(empty, ["dogsheep/github-to-sqlite"]) is None
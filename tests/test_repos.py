@@ -60,6 +60,7 @@ def test_repos(mocked, tmpdir):
         "users_fts_idx",
         "users_fts_docsize",
         "users_fts_config",
+        "_db_shape",
     ]
     assert db["repos"].count == 1
     repo = next(iter(db["repos"].rows))
@@ -108,3 +109,28 @@ def _run_repos(tmpdir):
     )
     assert 0 == result.exit_code
     return db_path
+
+
+def test_readme_skipped_when_not_pushed(requests_mock, tmpdir):
+    repo = json.load(open(pathlib.Path(__file__).parent / "repo.json"))
+    requests_mock.get(
+        "https://api.github.com/repos/dogsheep/github-to-sqlite",
+        [{"json": repo}, {"json": repo}, {"json": dict(repo, pushed_at="2030-01-01")}],
+    )
+    readme = requests_mock.get(
+        "https://api.github.com/repos/dogsheep/github-to-sqlite/readme",
+        json={"content": base64.b64encode(b"# README").decode("utf-8")},
+    )
+    runner = CliRunner()
+    db_path = str(tmpdir / "test.db")
+    for i in range(3):
+        result = runner.invoke(
+            cli.cli,
+            ["repos", db_path, "-r", "dogsheep/github-to-sqlite", "--readme"],
+            catch_exceptions=False,
+        )
+        assert 0 == result.exit_code
+        db = sqlite_utils.Database(db_path)
+        assert "# README" == list(db["repos"].rows)[0]["readme"]
+    # The second run kept the README it already had
+    assert 2 == readme.call_count
@@ -1,4 +1,4 @@
-from github_to_sqlite import cli
+from github_to_sqlite import cli, utils
 from click.testing import CliRunner
 import json
 import sqlite_utils
@@ -81,3 +81,65 @@ def test_scrape_dependents(requests_mock):
                 "dependent_watchers": 6,
             },
         ] == rows
+
+
+def test_scrape_dependents_skips_known_repos(requests_mock, tmpdir):
+    requests_mock.get(
+        "https://github.com/dogsheep/github-to-sqlite/network/dependents",
+        text="""
+        <a data-hovercard-type="repository" href="/simonw/foo">
+        <a data-hovercard-type="repository" href="/simonw/bar">
+        <a data-hovercard-type="repository" href="/simonw/foo">
+        """,
+    )
+    requests_mock.get(
+        "https://api.github.com/repos/dogsheep/github-to-sqlite", json=REPO
+    )
+    foo = requests_mock.get(
+        "https://api.github.com/repos/simonw/foo",
+        json=dict(REPO, id=1, full_name="simonw/foo"),
+    )
+    bar = requests_mock.get(
+        "https://api.github.com/repos/simonw/bar",
+        json=dict(REPO, id=2, full_name="simonw/bar"),
+    )
+    db_path = str(tmpdir / "scrape.db")
+    args = ["scrape-dependents", db_path, "dogsheep/github-to-sqlite"]
+    result = CliRunner().invoke(cli.cli, args + ["--concurrency", "2"])
+    assert 0 == result.exit_code
+    # Duplicates on the scraped pages are only fetched once
+    assert (1, 1) == (foo.call_count, bar.call_count)
+    db = sqlite_utils.Database(db_path)
+    first_seen = {r["dependent"]: r["first_seen_utc"] for r in db["dependents"].rows}
+    assert {1, 2} == set(first_seen)
+    assert ["full_name"] in [index.columns for index in db["repos"].indexes]
+    # A second run does not fetch repos it already has or re-insert pairs
+    result = CliRunner().invoke(cli.cli, args)
+    assert 0 == result.exit_code
+    assert (1, 1) == (foo.call_count, bar.call_count)
+    assert first_seen == {
+        r["dependent"]: r["first_seen_utc"] for r in db["dependents"].rows
+    }
+
+
+def test_scrape_dependents_backs_off_when_rate_limited(requests_mock, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(utils.time, "sleep", sleeps.append)
+    page_2 = "https://github.com/simonw/foo/network/dependents?dependents_after=abc"
+    requests_mock.get(
+        "https://github.com/simonw/foo/network/dependents",
+        text="""
+        <a data-hovercard-type="repository" href="/simonw/bar">
+        <div class="paginate-container"><a href="{}">Next</a></div>
+        """.format(page_2),
+    )
+    requests_mock.get(
+        page_2,
+        [
+            {"status_code": 429, "headers": {"Retry-After": "5"}},
+            {"text": '<a data-hovercard-type="repository" href="/simonw/baz">'},
+        ],
+    )
+    assert ["simonw/bar", "simonw/baz"] == list(utils.scrape_dependents("simonw/foo"))
+    # No wait for the first page, then the delay shrinks until the 429
+    assert [0.75, 5] == sleeps
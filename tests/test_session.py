@@ -0,0 +1,61 @@
+from github_to_sqlite import utils
+import json
+import pathlib
+import pytest
+import requests
+import requests_mock
+
+REPO = json.load(open(pathlib.Path(__file__).parent / "repo.json"))
+
+
+@pytest.fixture
+def injected_session():
+    session = requests.Session()
+    adapter = requests_mock.Adapter()
+    session.mount("https://", adapter)
+    utils.set_session(session)
+    yield adapter
+    utils.set_session(None)
+
+
+def test_make_session():
+    session = utils.make_session(pool_size=25, max_retries=5)
+    adapter = session.get_adapter("https://api.github.com/")
+    assert 25 == adapter._pool_maxsize
+    assert 5 == adapter.max_retries.total
+    assert 503 in adapter.max_retries.status_forcelist
+    assert "gzip" in session.headers["Accept-Encoding"]
+
+
+def test_get_session_is_shared():
+    assert utils.get_session() is utils.get_session()
+
+
+def test_injected_session_is_used(injected_session):
+    injected_session.register_uri(
+        "GET", "https://api.github.com/repos/dogsheep/github-to-sqlite", json=REPO
+    )
+    repo = utils.fetch_repo("dogsheep/github-to-sqlite", "xxx")
+    assert 207052882 == repo["id"]
+    assert "token xxx" == injected_session.last_request.headers["authorization"]
+
+
+def test_nested_concurrency_grows_connection_pool():
+    session = utils.make_session(pool_size=2)
+    utils.set_session(session)
+    adapter = session.get_adapter("https://api.github.com/")
+    sizes = []
+
+    def fetch_pages(n):
+        # Like a repo fetched by a worker, prefetching four pages at a time
+        with utils.reserve_connections(4):
+            sizes.append(adapter._pool_maxsize)
+        return n
+
+    try:
+        assert [0, 1, 2] == list(utils.map_concurrently(fetch_pages, range(3), 3))
+    finally:
+        utils.set_session(None)
+    # At least the main thread, three workers and one worker's four prefetches
+    assert max(sizes) >= 1 + 3 + 4
+    assert 1 == session.workers
@@ -45,6 +45,7 @@ def test_tables(db):
         "users_fts_config",
         "licenses_fts_idx",
         "users_fts_data",
+        "_db_shape",
     } == set(db.table_names())
 
 
@@ -239,3 +240,27 @@ def test_repos_starred_view(db):
             "topics": None,
         }
     ] == rows
+
+
+def test_save_stars_writes_shared_rows_once(starred, user, monkeypatch):
+    db = sqlite_utils.Database(memory=True)
+    stars = [
+        dict(starred[0], repo=dict(starred[0]["repo"], id=id, full_name=str(id)))
+        for id in range(1, 6)
+    ]
+    writes = []
+    for method in ("insert", "insert_all"):
+        original = getattr(sqlite_utils.db.Table, method)
+
+        def wrapped(table, *args, original=original, method=method, **kwargs):
+            writes.append((method, table.name))
+            return original(table, *args, **kwargs)
+
+        monkeypatch.setattr(sqlite_utils.db.Table, method, wrapped)
+    utils.save_stars(db, user, stars)
+    # One license and one batch each of repos and stars
+    assert 1 == writes.count(("insert", "licenses"))
+    assert 1 == writes.count(("insert_all", "repos"))
+    assert 1 == writes.count(("insert_all", "stars"))
+    assert 5 == db["stars"].count
+    assert [1, 2, 3, 4, 5] == [row["id"] for row in db["repos"].rows]
@@ -0,0 +1,133 @@
+from click.testing import CliRunner
+from github_to_sqlite import cli, utils
+import json
+import pathlib
+import pytest
+import sqlite_utils
+
+REPO = json.load(open(pathlib.Path(__file__).parent / "repo.json"))
+ISSUES = json.load(open(pathlib.Path(__file__).parent / "issues.json"))
+RELEASES = json.load(open(pathlib.Path(__file__).parent / "releases.json"))
+COMMENTS = json.load(open(pathlib.Path(__file__).parent / "issue-comments.json"))
+for issue in ISSUES:
+    for label in issue["labels"]:
+        label.setdefault("description", None)
+
+
+@pytest.fixture
+def mock_api(requests_mock):
+    mocks = {}
+    for id, name in ((1, "simonw/one"), (2, "simonw/two")):
+        base = "https://api.github.com/repos/{}".format(name)
+        mocks[name] = requests_mock.get(base, json=dict(REPO, id=id, full_name=name))
+        requests_mock.get(
+            base + "/issues",
+            json=[
+                dict(
+                    issue,
+                    id=issue["id"] + id,
+                    url="{}/issues/{}".format(base, issue["number"]),
+                )
+                for issue in ISSUES
+            ],
+        )
+        requests_mock.get(
+            base + "/issues/comments",
+            json=[
+                dict(
+                    comment,
+                    id=comment["id"] + id,
+                    issue_url="{}/issues/{}".format(base, ISSUES[0]["number"]),
+                )
+                for comment in COMMENTS
+            ],
+        )
+        requests_mock.get(
+            base + "/releases",
+            json=[dict(release, id=release["id"] + id) for release in RELEASES],
+        )
+    return mocks
+
+
+@pytest.mark.parametrize("concurrency", ["1", "3"])
+def test_sync(mock_api, tmpdir, monkeypatch, concurrency):
+    ensure_calls = []
+    monkeypatch.setattr(utils, "ensure_db_shape", ensure_calls.append)
+    db_path = str(tmpdir / "github.db")
+    result = CliRunner().invoke(
+        cli.cli,
+        [
+            "sync",
+            db_path,
+            "simonw/one",
+            "simonw/two",
+            "-r",
+            "issue-comments",
+            "-r",
+            "releases",
+            "-r",
+            "issues",
+            "--incremental",
+            "--concurrency",
+            concurrency,
+        ],
+        catch_exceptions=False,
+    )
+    assert 0 == result.exit_code, result.output
+    assert 1 == len(ensure_calls)
+    assert [1, 1] == [mock.call_count for mock in mock_api.values()]
+    db = sqlite_utils.Database(db_path)
+    for table, count in (
+        ("issues", len(ISSUES)),
+        ("releases", len(RELEASES)),
+        ("issue_comments", len(COMMENTS)),
+    ):
+        assert [(1, count), (2, count)] == db.execute(
+            "select repo, count(*) from {} group by repo order by repo".format(table)
+            if table != "issue_comments"
+            else "select issues.repo, count(*) from issue_comments "
+            "join issues on issue_comments.issue = issues.id "
+            "group by issues.repo order by issues.repo"
+        ).fetchall()
+    assert {"issues", "issue_comments"} == {
+        row["resource"] for row in db["_sync_state"].rows
+    }
+
+
+def test_sync_requires_repos(tmpdir):
+    result = CliRunner().invoke(cli.cli, ["sync", str(tmpdir / "github.db")])
+    assert 2 == result.exit_code
+    assert "Provide one or more repositories or --org" in result.output
+
+
+@pytest.mark.parametrize("concurrency", ["1", "3"])
+def test_sync_continues_after_errors(mock_api, requests_mock, tmpdir, concurrency):
+    # Issues are disabled for one repo, and fail for the other
+    mock_api["simonw/one"] = requests_mock.get(
+        "https://api.github.com/repos/simonw/one",
+        json=dict(REPO, id=1, full_name="simonw/one", has_issues=False),
+    )
+    disabled = requests_mock.get(
+        "https://api.github.com/repos/simonw/one/issues", status_code=410, json={}
+    )
+    requests_mock.get(
+        "https://api.github.com/repos/simonw/two/issues",
+        status_code=410,
+        json={"message": "Issues are disabled for this repo"},
+    )
+    db_path = str(tmpdir / "github.db")
+    result = CliRunner().invoke(
+        cli.cli,
+        ["sync", db_path, "simonw/one", "simonw/two"]
+        + ["-r", "issues", "-r", "releases", "--concurrency", concurrency],
+    )
+    assert 1 == result.exit_code
+    assert (
+        "Error syncing issues for simonw/two: Issues are disabled for this repo"
+        in result.stderr
+    )
+    assert not disabled.called
+    db = sqlite_utils.Database(db_path)
+    assert [(1, len(RELEASES)), (2, len(RELEASES))] == db.execute(
+        "select repo, count(*) from releases group by repo order by repo"
+    ).fetchall()
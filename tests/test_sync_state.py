@@ -0,0 +1,74 @@
+from click.testing import CliRunner
+from github_to_sqlite import cli, utils
+import json
+import pathlib
+import sqlite_utils
+
+REPO = json.load(open(pathlib.Path(__file__).parent / "repo.json"))
+ISSUES = json.load(open(pathlib.Path(__file__).parent / "issues.json"))
+# The labels FTS index expects the description the live API always returns
+for issue in ISSUES:
+    for label in issue["labels"]:
+        label.setdefault("description", None)
+PULLS = "https://api.github.com/repos/simonw/datasette/pulls"
+
+
+def test_sync_state_only_advances():
+    db = sqlite_utils.Database(memory=True)
+    assert utils.get_sync_state(db, "simonw/datasette", "issues") is None
+    utils.save_sync_state(db, "simonw/datasette", "issues", "2020-05-01T00:00:00Z")
+    utils.save_sync_state(db, "simonw/datasette", "issues", "2020-04-01T00:00:00Z")
+    utils.save_sync_state(db, "simonw/datasette", "issues", None)
+    assert "2020-05-01T00:00:00Z" == utils.get_sync_state(
+        db, "simonw/datasette", "issues"
+    )
+    assert utils.get_sync_state(db, "simonw/datasette", "issue_comments") is None
+
+
+def test_incremental_issues(requests_mock, tmpdir):
+    requests_mock.get(
+        "https://api.github.com/repos/simonw/datasette",
+        json=dict(REPO, full_name="simonw/datasette"),
+    )
+    issues = requests_mock.get(
+        "https://api.github.com/repos/simonw/datasette/issues", json=ISSUES
+    )
+    db_path = str(tmpdir / "issues.db")
+    for i in range(2):
+        result = CliRunner().invoke(
+            cli.cli,
+            ["issues", db_path, "simonw/datasette", "--incremental"],
+            catch_exceptions=False,
+        )
+        assert 0 == result.exit_code
+    newest = max(issue["updated_at"] for issue in ISSUES)
+    assert "since" not in issues.request_history[0].qs
+    assert [newest.lower()] == issues.last_request.qs["since"]
+    db = sqlite_utils.Database(db_path)
+    assert [
+        {"repo": "simonw/datasette", "resource": "issues", "updated_at": newest}
+    ] == list(db["_sync_state"].rows)
+
+
+def test_incremental_pull_requests_stop_early(requests_mock):
+    requests_mock.get(
+        PULLS,
+        json=[
+            {"id": 3, "updated_at": "2020-05-03T00:00:00Z"},
+            {"id": 2, "updated_at": "2020-05-02T00:00:00Z"},
+            {"id": 1, "updated_at": "2020-05-01T00:00:00Z"},
+        ],
+        headers={"Link": '<{}?page=2>; rel="next"'.format(PULLS)},
+    )
+    fetched = list(
+        utils.fetch_pull_requests("simonw/datasette", since="2020-05-02T00:00:00Z")
+    )
+    assert [3, 2] == [pull["id"] for pull in fetched]
+    # Never went on to page 2
+    assert 1 == requests_mock.call_count
+    assert {
+        "state": ["all"],
+        "sort": ["updated"],
+        "direction": ["desc"],
+        "per_page": ["100"],
+    } == requests_mock.last_request.qs
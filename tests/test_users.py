@@ -0,0 +1,67 @@
+from github_to_sqlite import utils
+import pytest
+import sqlite_utils
+
+
+@pytest.fixture
+def db():
+    return sqlite_utils.Database(memory=True)
+
+
+def test_save_user_writes_immediately(db):
+    utils.save_user(db, {"id": 1, "login": "one"})
+    utils.save_user(db, {"id": 2, "login": "two"})
+    assert 2 == db["users"].count
+
+
+def test_buffered_users_flushes_at_end(db):
+    with utils.buffered_users(db):
+        utils.save_user(db, {"id": 1, "login": "one"})
+        # The first user is written straight away so the table exists
+        assert 1 == db["users"].count
+        assert 2 == utils.save_user(db, {"id": 2, "login": "two"})
+        assert 1 == db["users"].count
+    assert [
+        {"id": 1, "login": "one", "name": "one"},
+        {"id": 2, "login": "two", "name": "two"},
+    ] == list(db["users"].rows)
+
+
+def test_buffered_users_flushes_on_error(db):
+    with pytest.raises(ZeroDivisionError):
+        with utils.buffered_users(db):
+            utils.save_user(db, {"id": 1, "login": "one"})
+            utils.save_user(db, {"id": 2, "login": "two"})
+            1 / 0
+    assert 2 == db["users"].count
+
+
+def test_save_user_flushes_in_batches(db, monkeypatch):
+    monkeypatch.setattr(utils, "USER_BATCH_SIZE", 3)
+    with utils.buffered_users(db):
+        for i in range(1, 6):
+            utils.save_user(db, {"id": i, "login": "user{}".format(i)})
+        assert 4 == db["users"].count
+    assert 5 == db["users"].count
+
+
+def test_save_user_skips_unchanged_users(db):
+    user = {"id": 1, "login": "one", "url": "https://api.github.com/users/one"}
+    utils.save_user(db, user)
+    utils.flush_users(db)
+    db["users"].update(1, {"name": "Changed outside this run"})
+    utils.save_user(db, user)
+    utils.flush_users(db)
+    assert "Changed outside this run" == db["users"].get(1)["name"]
+
+
+def test_nested_user_does_not_blank_full_user(db):
+    with utils.buffered_users(db):
+        utils.save_user(db, {"id": 1, "login": "one"})
+        utils.save_user(db, {"id": 1, "login": "one", "name": "One", "bio": "Hello"})
+        utils.save_user(db, {"id": 2, "login": "two"})
+        utils.save_user(db, {"id": 1, "login": "one"})
+    assert [
+        {"id": 1, "login": "one", "name": "one", "bio": "Hello"},
+        {"id": 2, "login": "two", "name": "two", "bio": None},
+    ] == list(db["users"].rows)